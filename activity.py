@@ -0,0 +1,149 @@
+import bisect
+import threading
+import time
+from collections import namedtuple
+
+from pagination import Page, decode_key
+from timeline import CURSOR_TYPES, encode_timeline_cursor
+
+# Sitewide "latest activity": new reviews and newly added books, movies and games, newest first.
+#
+# The newest `size` events live in a buffer per worker process, filled by one query when first needed and
+# then kept current by the routes that write reviews and items, so the homepage strip, the first pages of
+# /activity and the long-poll endpoint answer without touching the database. Pages older than the buffer
+# come from `load`, the review tables merged by the database (items have no creation time stored, so only
+# their live events are shown).
+#
+# Events are ordered like the review timelines by (created_at, type rank, id); item events rank after the
+# review types. A worker sees its own writes at once and everyone else's when it reloads the buffer, every
+# `reload_interval` seconds.
+
+Activity = namedtuple('Activity', ['kind', 'item_type', 'type_rank', 'id', 'created_at', 'item_id', 'title',
+                                   'user_id', 'username', 'excerpt'])
+
+EXCERPT_LENGTH = 200
+
+
+def excerpt(text):
+    text = ' '.join((text or '').split())
+    return text if len(text) <= EXCERPT_LENGTH else text[:EXCERPT_LENGTH - 1].rstrip() + '…'
+
+
+def event_key(event):
+    return event.created_at, event.type_rank, event.id
+
+
+class ActivityFeed:
+    # load(limit, after=None): one Page of review events, newest first, older than the `after` cursor
+
+    def __init__(self, load, size=200, reload_interval=300, max_waiters=100):
+        self.load = load
+        self.size = size
+        self.reload_interval = reload_interval
+        self.max_waiters = max_waiters
+        self._events = []  # oldest first
+        self._keys = []
+        self._complete = False  # True while the buffer holds every review there is
+        self._loaded_at = None
+        self._loading = False
+        self._added_while_loading = []  # add() / remove() calls made while a load runs, applied to its result
+        self._removed_while_loading = []
+        self._waiters = 0
+        self._changed = threading.Condition()
+
+    def _ensure_loaded(self):
+        # Called without the lock: the query runs unlocked, so readers of the current buffer and long-poll
+        # waiters never queue behind it, and the lock is only taken to install its result. While one thread
+        # loads, the others go on with the buffer they have (or wait for it if there is none yet).
+        with self._changed:
+            while self._loading and self._loaded_at is None:
+                self._changed.wait()
+            if self._loading or (self._loaded_at is not None and
+                                 time.monotonic() - self._loaded_at < self.reload_interval):
+                return
+            self._loading = True
+            self._added_while_loading, self._removed_while_loading = [], []
+        try:
+            page = self.load(self.size)
+        except BaseException:
+            with self._changed:
+                self._loading = False
+                self._changed.notify_all()
+            raise
+        with self._changed:
+            # item events only exist in memory, keep them, and the events added while the query ran
+            kept = [event for event in self._events if event.kind == 'item'] + self._added_while_loading
+            events = {event_key(event): event for event in list(page.items) + kept
+                      if not any(predicate(event) for predicate in self._removed_while_loading)}
+            self._events = sorted(events.values(), key=event_key)[-self.size:]
+            self._keys = [event_key(event) for event in self._events]
+            self._complete = page.next_cursor is None and len(self._events) < self.size
+            self._loaded_at = time.monotonic()
+            self._loading = False
+            self._added_while_loading, self._removed_while_loading = [], []
+            self._changed.notify_all()
+
+    def add(self, event):
+        with self._changed:
+            if self._loading:
+                self._added_while_loading.append(event)
+            if self._loaded_at is None:
+                return  # nothing cached yet, the first load will read it from the database
+            key = event_key(event)
+            position = bisect.bisect(self._keys, key)
+            self._events.insert(position, event)
+            self._keys.insert(position, key)
+            if len(self._events) > self.size:
+                del self._events[0], self._keys[0]
+                self._complete = False
+            self._changed.notify_all()
+
+    def remove(self, predicate):
+        # drops events, e.g. of a deleted review or of deleted items
+        with self._changed:
+            if self._loading:
+                self._removed_while_loading.append(predicate)
+            kept = [event for event in self._events if not predicate(event)]
+            if len(kept) != len(self._events):
+                self._events = kept
+                self._keys = [event_key(event) for event in kept]
+
+    def latest(self, limit):
+        self._ensure_loaded()
+        with self._changed:
+            return self._events[:-limit - 1:-1]
+
+    def page(self, limit, after=None):
+        # One page, newest first, from memory when the buffer holds it and from `load` when it reaches further back
+        cursor = decode_key(after, CURSOR_TYPES) if after else None
+        self._ensure_loaded()
+        with self._changed:
+            end = bisect.bisect_left(self._keys, cursor) if cursor else len(self._events)
+            older = self._events[max(0, end - limit - 1):end][::-1]
+            complete = self._complete
+        if len(older) > limit or complete:
+            next_cursor = encode_timeline_cursor(older[limit - 1]) if len(older) > limit else None
+            return Page(older[:limit], next_cursor, None)
+        return self.load(limit, after)
+
+    def wait(self, since, timeout):
+        # Long poll: events newer than the `since` cursor, oldest first, waiting up to `timeout` seconds for one.
+        # Past max_waiters the caller gets an empty answer right away instead of another thread parked here.
+        since = decode_key(since, CURSOR_TYPES) if since else None
+        deadline = time.monotonic() + timeout
+        self._ensure_loaded()  # once, before waiting, never from inside the wait
+        with self._changed:
+            if self._waiters >= self.max_waiters:
+                return []
+            self._waiters += 1
+            try:
+                while True:
+                    if since is None:
+                        return self._events[-1:]
+                    newer = self._events[bisect.bisect_right(self._keys, since):]
+                    remaining = deadline - time.monotonic()
+                    if newer or remaining <= 0:
+                        return newer
+                    self._changed.wait(remaining)
+            finally:
+                self._waiters -= 1
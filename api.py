@@ -0,0 +1,88 @@
+import json
+from datetime import datetime
+
+from flask import Response, jsonify, request, stream_with_context
+
+# Read-only export of whole tables, streamed row by row so neither the server nor the client has to
+# hold a large result in memory. Rows always come in id order and the database is read in batches
+# (yield_per), so a client that got cut off resumes with ?since=<last id it received>.
+#
+#   /api/books?fields=id,title,genre&since=1200&limit=500
+#
+# The default response is one JSON document sent in chunks, {"items": [...], "next_since": ...}, where
+# next_since is the id to continue from when the limit was reached and null at the end of the table.
+# ?format=ndjson (or Accept: application/x-ndjson) sends one JSON object per line instead.
+
+NDJSON = 'application/x-ndjson'
+
+
+class ApiError(ValueError):
+    pass
+
+
+def _encode(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    raise TypeError(f'{type(value).__name__} is not JSON serializable')
+
+
+def selected_fields(raw, available):
+    # ?fields=a,b picks columns; id is always included since it is what a client resumes from
+    if not raw:
+        return list(available)
+    fields = ['id'] + [field for field in raw.split(',') if field and field != 'id']
+    unknown = [field for field in fields if field not in available]
+    if unknown:
+        raise ApiError(f'unknown fields: {", ".join(unknown)}; available: {", ".join(available)}')
+    return list(dict.fromkeys(fields))
+
+
+def int_arg(name, default=None, minimum=0):
+    value = request.args.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ApiError(f'{name} must be an integer') from None
+    if number < minimum:
+        raise ApiError(f'{name} must be at least {minimum}')
+    return number
+
+
+def _ndjson(rows, fields):
+    for row in rows:
+        yield json.dumps(dict(zip(fields, row)), default=_encode) + '\n'
+
+
+def _json(rows, fields, limit):
+    yield '{"items": ['
+    count, last_id = 0, None
+    for row in rows:
+        yield (',\n' if count else '\n') + json.dumps(dict(zip(fields, row)), default=_encode)
+        count += 1
+        last_id = row[0]
+    next_since = last_id if limit and count == limit else None
+    yield f'\n], "next_since": {json.dumps(next_since)}}}\n'
+
+
+def stream_table(query, columns, max_limit, batch_size=1000):
+    # `columns` maps field names to column expressions and must start with the id column
+    try:
+        fields = selected_fields(request.args.get('fields'), columns)
+        since = int_arg('since', 0)
+        limit = int_arg('limit', max_limit, minimum=1)
+    except ApiError as error:
+        return jsonify(error=str(error)), 400
+    if max_limit:
+        limit = min(limit, max_limit)
+
+    id_column = columns['id']
+    query = query.with_entities(*[columns[field] for field in fields]).filter(id_column > since).order_by(id_column)
+    if limit:
+        query = query.limit(limit)
+    rows = query.yield_per(batch_size)
+
+    if request.args.get('format') == 'ndjson' or NDJSON in request.headers.get('Accept', ''):
+        return Response(stream_with_context(_ndjson(rows, fields)), mimetype=NDJSON)
+    return Response(stream_with_context(_json(rows, fields, limit)), mimetype='application/json')
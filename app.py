@@ -1,19 +1,165 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from flask import Flask, render_template, request, redirect, url_for, flash, session, abort, jsonify, send_file
 from flask_sqlalchemy import SQLAlchemy
 from forms import RegistrationForm, LoginForm, ProfileForm, ReviewForm, BookForm, MovieForm, GameForm, ISBNForm, IMDBForm
-from werkzeug.security import check_password_hash, generate_password_hash
-from werkzeug.utils import secure_filename
 from flask_login import LoginManager, UserMixin, login_user, login_required, current_user, logout_user
 from urllib.parse import quote
-from sqlalchemy.sql.expression import func
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime
+from sqlalchemy.orm import make_transient_to_detached, selectinload
+from sqlalchemy.sql.expression import func, select
+from pagination import compound_keyset_page, keyset_page, page_size, shuffle_pivot, stable_shuffle
+from featured import FeaturedSampler
+from timeline import encode_timeline_cursor, review_timeline
+from activity import Activity, ActivityFeed, excerpt
+from assets import StaticAssets
+from passwords import HasherBusy, LoginLimiter, PasswordHasher
+from search import rebuild_search_index, search_catalogue
+from metadata_client import HttpBackend, MetadataClient, MetadataError, MetadataNotFound, ResponseCache
+from covers import CoverDownloader
+from images import AVATAR_SIZES, COVER_SIZES, ImageError, ImageSweeper, ImageTooLarge, add_missing_webp, hashed_image, is_content_addressed, store_upload
+from functools import partial
+from fragments import FragmentCache, MemoryBackend, SQLiteBackend
+from markupsafe import Markup
+from conditional import conditional
+from instrumentation import Instrumentation
+from identity import IdentityCache
+from database import configure_sqlite, database_uri, engine_options, sqlite_pragmas
+from counters import reconcile_review_counters
+from api import stream_table
+from genres import backfill_genres, genre_slug, link_genres, parse_genres, unlink_genres
+import click
+import uuid
+import math
 import os
-import requests
+import random
+import re
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'twystedspyne' # Change to an actually secure key if required
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///site.db' 
+app.config['SQLALCHEMY_DATABASE_URI'] = database_uri() # DATABASE_URL, defaults to the site.db SQLite file
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI']) # DB_POOL_SIZE and friends, see database.py
 app.config['UPLOAD_FOLDER'] = 'static/images'
+app.config['MAX_CONTENT_LENGTH'] = int(os.environ.get('MAX_CONTENT_LENGTH', 8 * 1024 * 1024)) # Largest request body, and so the largest cover / avatar upload
+app.config['MAX_IMAGE_PIXELS'] = 40_000_000 # Uploads with larger dimensions are refused from their header, before decoding
+app.config['CATALOGUE_PAGE_SIZE'] = 24
+app.config['REVIEWS_PAGE_SIZE'] = 20
+app.config['SEARCH_PAGE_SIZE'] = 20
+app.config['SEARCH_MAX_PAGES'] = 50
+app.config['OMDB_API_KEY'] = os.environ.get('OMDB_API_KEY', '8d437aa0')
+app.config['METADATA_TIMEOUT'] = (3.05, 10) # Connect and read timeouts in seconds for Open Library / OMDb
+app.config['METADATA_CACHE_PATH'] = os.path.join(app.instance_path, 'metadata_cache.sqlite')
+app.config['METADATA_CACHE_TTL'] = 7 * 24 * 3600
+app.config['METADATA_CACHE_NEGATIVE_TTL'] = 3600 # Unknown ISBNs / IMDB ids are remembered for an hour
+app.config['METADATA_CACHE_MAX_BYTES'] = 50 * 1024 * 1024
+app.config['COVER_DOWNLOAD_WORKERS'] = 2
+app.config['COVER_DOWNLOAD_QUEUE_SIZE'] = 100 # Pending cover downloads, further jobs are dropped and the default cover stays
+app.config['COVER_DOWNLOAD_RETRIES'] = 3
+app.config['IMMUTABLE_MAX_AGE'] = 365 * 24 * 3600 # Content-hashed images and fingerprinted static files never change, browsers may keep them for a year
+app.config['PASSWORD_HASH_METHOD'] = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:260000') # Older hashes are replaced at the next login
+app.config['PASSWORD_SALT_LENGTH'] = 16
+app.config['PASSWORD_HASH_WORKERS'] = int(os.environ.get('PASSWORD_HASH_WORKERS', 2)) # Processes hashing passwords per web worker, 0 hashes inline
+app.config['PASSWORD_HASH_QUEUE'] = 8 # Hashes running or waiting per web worker, logins beyond that are turned away
+app.config['PASSWORD_HASH_WAIT'] = 2 # Seconds a login waits for a free hashing slot
+app.config['LOGIN_ATTEMPTS_PER_USERNAME'] = 5 # Failed logins allowed per LOGIN_ATTEMPT_WINDOW before further ones are refused
+app.config['LOGIN_ATTEMPTS_PER_ADDRESS'] = 20
+app.config['LOGIN_ATTEMPT_WINDOW'] = 300
+app.config['TRUSTED_PROXIES'] = int(os.environ.get('TRUSTED_PROXIES', 0)) # Reverse proxies in front of the app, their X-Forwarded-For gives the client address the login limit counts
+app.config['STATIC_FINGERPRINT'] = os.environ.get('STATIC_FINGERPRINT', '1') == '1' # Hashed, precompressed URLs for static/ files, see assets.py
+app.config['FRAGMENT_CACHE'] = os.environ.get('FRAGMENT_CACHE', 'memory') # 'memory' per worker, 'sqlite' shared by workers, 'none'
+app.config['FRAGMENT_CACHE_SIZE'] = 2000 # Entries kept by the memory backend
+app.config['FRAGMENT_CACHE_PATH'] = os.path.join(app.instance_path, 'fragment_cache.sqlite')
+app.config['FRAGMENT_CACHE_MAX_BYTES'] = 100 * 1024 * 1024
+app.config['CATALOGUE_SHUFFLE'] = True # Start each session's listings at a random spot, set False for plain id order
+app.config['FEATURED_COUNT'] = 5
+app.config['FEATURED_TTL'] = 10 # Seconds the homepage carousels are reused for, 0 picks new items on every view
+app.config['INSTRUMENTATION'] = os.environ.get('INSTRUMENTATION') == '1' # Server-Timing headers, slow request log and /admin/timings
+app.config['SLOW_REQUEST_MS'] = 500
+app.config['SLOW_QUERY_MS'] = 100
+app.config['IDENTITY_CACHE_TTL'] = 60 # Seconds a logged in user is served from memory instead of the database, 0 disables
+app.config['IDENTITY_CACHE_SIZE'] = 10000
+app.config['API_MAX_ROWS'] = 0 # Most rows one /api/ response streams, 0 for whole tables
+app.config['API_BATCH_SIZE'] = 1000 # Rows fetched from the database at a time while streaming
+app.config['IMAGE_SWEEP_GRACE'] = 3600 # Unused covers / avatars younger than this are kept by the sweeper
+app.config['DELETE_BATCH_SIZE'] = 500 # Ids per DELETE ... WHERE id IN (...) statement
+app.config['SIMILAR_COUNT'] = 6 # Items in the "More like this" strip, `flask build-similar` keeps up to SIMILAR_KEEP per item
+app.config['SIMILAR_KEEP'] = 12
+app.config['SIMILAR_TEXT_WEIGHT'] = 0.7 # Share of synopsis / genre / creator likeness against co-reviews
+app.config['GENRE_FACETS'] = 30 # Genres listed next to a catalogue listing, most used first
+app.config['ACTIVITY_BUFFER_SIZE'] = 200 # Latest reviews / new items each worker keeps in memory for the activity feed
+app.config['ACTIVITY_RELOAD_INTERVAL'] = 60 # Seconds before the buffer is re-read to pick up other workers' writes
+app.config['ACTIVITY_HOME_COUNT'] = 8
+app.config['ACTIVITY_POLL_TIMEOUT'] = 25 # Seconds /activity/poll waits for something new before answering empty
+app.config['ACTIVITY_POLL_WAITERS'] = 100 # Long polls parked at once per worker, more are answered empty immediately
 db = SQLAlchemy(app)
+configure_sqlite(sqlite_pragmas())
+
+featured_sampler = FeaturedSampler(ttl=app.config['FEATURED_TTL'])
+
+app.add_template_global(hashed_image)
+
+if app.config['FRAGMENT_CACHE'] == 'sqlite':
+    fragment_cache = FragmentCache(SQLiteBackend(app.config['FRAGMENT_CACHE_PATH'], app.config['FRAGMENT_CACHE_MAX_BYTES']))
+elif app.config['FRAGMENT_CACHE'] == 'memory':
+    fragment_cache = FragmentCache(MemoryBackend(app.config['FRAGMENT_CACHE_SIZE']))
+else:
+    fragment_cache = FragmentCache(None)
+
+metadata_client = MetadataClient(
+    HttpBackend(*app.config['METADATA_TIMEOUT']),
+    ResponseCache(app.config['METADATA_CACHE_PATH'], app.config['METADATA_CACHE_MAX_BYTES']),
+    ttl=app.config['METADATA_CACHE_TTL'],
+    negative_ttl=app.config['METADATA_CACHE_NEGATIVE_TTL'],
+    omdb_api_key=app.config['OMDB_API_KEY'],
+)
+
+cover_downloader = CoverDownloader(
+    os.path.join(app.config['UPLOAD_FOLDER'], 'covers'),
+    workers=app.config['COVER_DOWNLOAD_WORKERS'],
+    queue_size=app.config['COVER_DOWNLOAD_QUEUE_SIZE'],
+    retries=app.config['COVER_DOWNLOAD_RETRIES'],
+)
+
+instrumentation = Instrumentation(app.config['SLOW_REQUEST_MS'], app.config['SLOW_QUERY_MS'])
+if app.config['INSTRUMENTATION']:
+    instrumentation.init_app(app)
+    instrumentation.track_session(metadata_client.backend.session)
+
+identity_cache = IdentityCache(app.config['IDENTITY_CACHE_TTL'], app.config['IDENTITY_CACHE_SIZE'])
+
+password_hasher = PasswordHasher(app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'],
+                                 workers=app.config['PASSWORD_HASH_WORKERS'],
+                                 max_pending=app.config['PASSWORD_HASH_QUEUE'], wait=app.config['PASSWORD_HASH_WAIT'])
+login_limiter = LoginLimiter(app.config['LOGIN_ATTEMPTS_PER_USERNAME'], app.config['LOGIN_ATTEMPTS_PER_ADDRESS'],
+                             app.config['LOGIN_ATTEMPT_WINDOW'])
+if app.config['TRUSTED_PROXIES']:
+    # otherwise every client behind the proxy shares its address, and its login limit
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['TRUSTED_PROXIES'], x_proto=app.config['TRUSTED_PROXIES'])
+
+# covers and avatars are content addressed already and change at runtime, so they are left out
+static_assets = StaticAssets(app.static_folder, os.path.join(app.static_folder, 'build'), exclude=[
+    os.path.join(app.root_path, app.config['UPLOAD_FOLDER'], folder) for folder in ('covers', 'avatars')])
+if app.config['STATIC_FINGERPRINT']:
+    static_assets.build()
+
+@app.url_defaults
+def fingerprint_static_urls(endpoint, values):
+    # every url_for('static', ...), in templates too, points at the fingerprinted name when there is one
+    if endpoint == 'static' and 'filename' in values:
+        values['filename'] = static_assets.url_filename(values['filename'])
+
+def send_static_asset(filename):
+    # Fingerprinted files are sent precompressed when the browser accepts it, anything else as Flask would
+    asset = static_assets.find(filename)
+    if asset is None:
+        return app.send_static_file(filename)
+    encoding, path = static_assets.choose(asset, request.accept_encodings)
+    response = send_file(path, mimetype=asset.mimetype, conditional=True)
+    if encoding:
+        response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+    return response
+
+app.view_functions['static'] = send_static_asset
 
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
@@ -22,16 +168,35 @@ login_manager.login_view = 'login'
 class User(db.Model, UserMixin):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(20), unique=True, nullable=False)    
-    password = db.Column(db.String(60), nullable=False)
-    bio = db.Column(db.String(180), nullable=True)
+    password = db.Column(db.String(255), nullable=False) # pbkdf2 hashes are longer than 60, only SQLite let that pass
+    bio = db.Column(db.String(500), nullable=True) # as long as ProfileForm allows
     book_reviews = db.relationship('BookReview', backref='user', lazy=True)
     game_reviews = db.relationship('GameReview', backref='user', lazy=True)
     movie_reviews = db.relationship('MovieReview', backref='user', lazy=True)
     avatar = db.Column(db.String(255), default='default_avatar.png') 
 
+USER_COLUMNS = ('id', 'username', 'password', 'bio', 'avatar')
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    # Served from the identity cache while the stamp in the session matches, the copy is attached to this
+    # request's session without a query so relationships and profile edits work as usual
+    stamp = session.get('identity_stamp')
+    values = identity_cache.get(int(user_id), stamp)
+    if values is not None:
+        user = User(**values)
+        make_transient_to_detached(user)
+        return db.session.merge(user, load=False)
+
+    user = User.query.get(int(user_id))
+    if user is not None:
+        identity_cache.set(user.id, stamp, {column: getattr(user, column) for column in USER_COLUMNS})
+    return user
+
+def renew_identity_stamp(user_id):
+    # After the user changes, or on login so a new session never picks up an older session's entry
+    identity_cache.invalidate(user_id)
+    session['identity_stamp'] = uuid.uuid4().hex[:12]
 
 class Book(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -40,7 +205,14 @@ class Book(db.Model):
     genre = db.Column(db.String(255), nullable=False)
     synopsis = db.Column(db.Text, nullable=True)
     cover_image = db.Column(db.String(255), default='default_cover.png')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_reviewed_at = db.Column(db.DateTime, nullable=True)
     reviews = db.relationship('BookReview', backref='book', lazy=True)
+    __table_args__ = (
+        db.Index('ix_book_most_reviewed', 'review_count', 'id'),
+        db.Index('ix_book_recently_reviewed', 'last_reviewed_at', 'id'),
+    )
 
 class Game(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -49,7 +221,14 @@ class Game(db.Model):
     genre = db.Column(db.String(255), nullable=False)
     synopsis = db.Column(db.Text, nullable=True)
     cover_image = db.Column(db.String(255), default='default_cover.png')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_reviewed_at = db.Column(db.DateTime, nullable=True)
     reviews = db.relationship('GameReview', backref='game', lazy=True)
+    __table_args__ = (
+        db.Index('ix_game_most_reviewed', 'review_count', 'id'),
+        db.Index('ix_game_recently_reviewed', 'last_reviewed_at', 'id'),
+    )
 
 class Movie(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -58,74 +237,382 @@ class Movie(db.Model):
     genre = db.Column(db.String(255), nullable=False)
     synopsis = db.Column(db.Text, nullable=True)
     cover_image = db.Column(db.String(255), default='default_cover.png')
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    review_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    last_reviewed_at = db.Column(db.DateTime, nullable=True)
     reviews = db.relationship('MovieReview', backref='movie', lazy=True)
+    __table_args__ = (
+        db.Index('ix_movie_most_reviewed', 'review_count', 'id'),
+        db.Index('ix_movie_recently_reviewed', 'last_reviewed_at', 'id'),
+    )
 
 class BookReview(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     book_id = db.Column(db.Integer, db.ForeignKey('book.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_book_review_book_id_created_at', 'book_id', 'created_at'),
+        db.Index('ix_book_review_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_book_review_created_at', 'created_at', 'id'),
+    )
 
 class MovieReview(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     movie_id = db.Column(db.Integer, db.ForeignKey('movie.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_movie_review_movie_id_created_at', 'movie_id', 'created_at'),
+        db.Index('ix_movie_review_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_movie_review_created_at', 'created_at', 'id'),
+    )
 
 class GameReview(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     content = db.Column(db.Text, nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     game_id = db.Column(db.Integer, db.ForeignKey('game.id'), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (
+        db.Index('ix_game_review_game_id_created_at', 'game_id', 'created_at'),
+        db.Index('ix_game_review_user_id_created_at', 'user_id', 'created_at'),
+        db.Index('ix_game_review_created_at', 'created_at', 'id'),
+    )
+
+class CollectionVersion(db.Model):
+    # Change counters for pages built from many rows, read to answer conditional requests cheaply:
+    # 'book' / 'movie' / 'game' for the listings, 'user:<id>' for a public profile, 'avatars' for review lists,
+    # '<type>:reviews' for the review sorted listings and '<type>:similar' for the "More like this" strips
+    name = db.Column(db.String(40), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class Genre(db.Model):
+    # One row per distinct genre name, linked to items through the <type>_genre tables (see genres.py)
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)
+    slug = db.Column(db.String(100), nullable=False, unique=True)
+
+class GenreCount(db.Model):
+    # Items per type and genre for the facet lists, kept up to date by link_genres / unlink_genres
+    item_type = db.Column(db.String(10), primary_key=True)
+    genre_id = db.Column(db.Integer, db.ForeignKey('genre.id'), primary_key=True)
+    item_count = db.Column(db.Integer, nullable=False, default=0)
+    genre = db.relationship('Genre', lazy='joined')
+    __table_args__ = (
+        db.Index('ix_genre_count_item_type_item_count', 'item_type', 'item_count'),
+    )
+
+# item headers link every genre to its filtered listing
+app.add_template_filter(parse_genres, 'genres')
+app.add_template_filter(genre_slug)
+
+# (genre, item) primary keys read a genre's items in id order, the item index finds an item's genres
+GENRE_LINK_TABLES = {
+    item_type: db.Table(
+        f'{item_type}_genre',
+        db.Column('genre_id', db.Integer, db.ForeignKey('genre.id'), primary_key=True),
+        db.Column(f'{item_type}_id', db.Integer, db.ForeignKey(f'{item_type}.id'), primary_key=True),
+        db.Index(f'ix_{item_type}_genre_{item_type}_id', f'{item_type}_id'),
+    )
+    for item_type in ('book', 'movie', 'game')
+}
+
+class SimilarItem(db.Model):
+    # Precomputed "More like this" neighbours, best first, written by `flask build-similar` (see similar.py)
+    item_type = db.Column(db.String(10), primary_key=True)
+    item_id = db.Column(db.Integer, primary_key=True)
+    position = db.Column(db.Integer, primary_key=True)
+    similar_id = db.Column(db.Integer, nullable=False)
+    score = db.Column(db.Float, nullable=False)
+    __table_args__ = (
+        db.Index('ix_similar_item_similar_id', 'item_type', 'similar_id'),
+    )
+
+class SimilarBuild(db.Model):
+    # When the neighbours of each item type were last refreshed and the highest id seen, for incremental builds
+    item_type = db.Column(db.String(10), primary_key=True)
+    built_at = db.Column(db.DateTime, nullable=False)
+    max_id = db.Column(db.Integer, nullable=False)
+
+CATALOGUE_MODELS = {'book': Book, 'movie': Movie, 'game': Game}
+
+# (item type, review model, item model, foreign key) for merging the three review tables, in tie-break order
+REVIEW_SOURCES = [
+    ('book', BookReview, Book, BookReview.book_id),
+    ('movie', MovieReview, Movie, MovieReview.movie_id),
+    ('game', GameReview, Game, GameReview.game_id),
+]
 
 # Routes
 @app.route('/')
 def index():
-    # show 5 random things from the database
-    random_books = Book.query.order_by(func.random()).limit(5).all()   
-    random_movies = Movie.query.order_by(func.random()).limit(5).all()  
-    random_games = Game.query.order_by(func.random()).limit(5).all()  
-
-    return render_template('index.html', random_books=random_books, random_movies=random_movies, random_games=random_games)
+    # show a few random things from the database, drawn from the in-memory id arrays instead of ORDER BY RANDOM()
+    featured = featured_sampler.featured([Book, Movie, Game], app.config['FEATURED_COUNT'])
+
+    return render_template('index.html', random_books=featured[Book], random_movies=featured[Movie], random_games=featured[Game],
+                           activity=activity_feed.latest(app.config['ACTIVITY_HOME_COUNT']))
+
+def listing_sort():
+    sort = request.args.get('sort')
+    return sort if sort in LISTING_SORTS else None
+
+# ?sort= options of the listings, each served by an index on (column, id)
+LISTING_SORTS = {'reviews': 'review_count', 'recent': 'last_reviewed_at'}
+
+def listing_genre():
+    # ?genre=<slug> narrows a listing down to one genre
+    slug = request.args.get('genre')
+    return Genre.query.filter_by(slug=slug).first_or_404() if slug else None
+
+def get_catalogue_page(model, genre=None):
+    # One page of a listing, read by id range instead of sorting the whole table with ORDER BY RANDOM()
+    limit = page_size(request.args.get('limit'), app.config['CATALOGUE_PAGE_SIZE'])
+    sort = listing_sort()
+    query, key_column = model.query, model.id
+    if genre is not None:
+        # paged along the (genre_id, item id) primary key of the link table, which is in id order already
+        link = GENRE_LINK_TABLES[model.__tablename__]
+        key_column = link.c[f'{model.__tablename__}_id']
+        query = query.join(link, key_column == model.id).filter(link.c.genre_id == genre.id)
+    if sort:
+        column = getattr(model, LISTING_SORTS[sort])
+        query = query.filter(column.isnot(None))
+        return compound_keyset_page(query, (column, model.id), limit, after=request.args.get('after'),
+                                    before=request.args.get('before'), descending=True)
+
+    pivot = None
+    seed = None
+
+    if app.config['CATALOGUE_SHUFFLE']:
+        # a per-session seed keeps the "random" order stable while the user pages back and forth
+        if 'reshuffle' in request.args or 'shuffle_seed' not in session:
+            session['shuffle_seed'] = random.getrandbits(32)
+        seed = session['shuffle_seed']
+        pivot = shuffle_pivot(seed, db.session.query(func.max(model.id)).scalar())
+
+    page = keyset_page(query, key_column, limit, after=request.args.get('after'), before=request.args.get('before'),
+                       pivot=pivot, key_attribute='id')
+    if seed is not None:
+        stable_shuffle(page.items, seed)
+    return page
 
 @app.route('/books')
+@conditional(lambda: listing_etag(Book))
 def books():
-    all_books = Book.query.order_by(func.random()).all()  
+    genre = listing_genre()
+    page = get_catalogue_page(Book, genre)
 
-    return render_template('books.html', all_books=all_books)
+    return render_template('books.html', all_books=page.items, page=page, sort=listing_sort(), genre=genre,
+                           genre_facets=genre_facets('book', 'books', genre))
 
 @app.route('/movies')
+@conditional(lambda: listing_etag(Movie))
 def movies():
-    all_movies = Movie.query.order_by(func.random()).all()  
+    genre = listing_genre()
+    page = get_catalogue_page(Movie, genre)
 
-    return render_template('movies.html', all_movies=all_movies)
+    return render_template('movies.html', all_movies=page.items, page=page, sort=listing_sort(), genre=genre,
+                           genre_facets=genre_facets('movie', 'movies', genre))
 
 @app.route('/games')
+@conditional(lambda: listing_etag(Game))
 def games():
-    all_games = Game.query.order_by(func.random()).all()  
-
-    return render_template('games.html', all_games=all_games)
+    genre = listing_genre()
+    page = get_catalogue_page(Game, genre)
+
+    return render_template('games.html', all_games=page.items, page=page, sort=listing_sort(), genre=genre,
+                           genre_facets=genre_facets('game', 'games', genre))
+
+def genre_facets(item_type, endpoint, genre):
+    # The most used genres with their item counts, rendered once per change of the catalogue rather than per view
+    sort = listing_sort()
+
+    def render():
+        facets = (GenreCount.query.filter(GenreCount.item_type == item_type, GenreCount.item_count > 0)
+                  .order_by(GenreCount.item_count.desc(), GenreCount.genre_id)
+                  .limit(app.config['GENRE_FACETS']).all())
+        return render_template('genre_facets.html', facets=facets, endpoint=endpoint, sort=sort, genre=genre)
+
+    key = ('genres', item_type, sort or '', genre.slug if genre else '') + collection_versions(item_type)
+    return Markup(fragment_cache.get_or_render(key, render))
+
+def get_timeline_page(user_id):
+    # A user's reviews of all three types, merged, ordered and limited by a single UNION ALL query
+    return review_timeline(db.session, REVIEW_SOURCES, user_id,
+                           page_size(request.args.get('limit'), app.config['REVIEWS_PAGE_SIZE']),
+                           after=request.args.get('after'), before=request.args.get('before'))
+
+def load_activity(limit, after=None):
+    # Everyone's reviews newest first, merged by the database like the profile timelines, authors in one IN query
+    page = review_timeline(db.session, REVIEW_SOURCES, None, limit, after=after)
+    usernames = dict(db.session.query(User.id, User.username).filter(User.id.in_({row.user_id for row in page.items})))
+    events = [Activity('review', row.item_type, row.type_rank, row.id, row.created_at, row.item_id, row.title,
+                       row.user_id, usernames.get(row.user_id), excerpt(row.content)) for row in page.items]
+    return page._replace(items=events)
+
+activity_feed = ActivityFeed(load_activity, size=app.config['ACTIVITY_BUFFER_SIZE'],
+                             reload_interval=app.config['ACTIVITY_RELOAD_INTERVAL'],
+                             max_waiters=app.config['ACTIVITY_POLL_WAITERS'])
+
+def review_activity(item_type, item, review):
+    # called after flush, while the review's id and created_at are loaded
+    rank = next(rank for rank, source in enumerate(REVIEW_SOURCES) if source[0] == item_type)
+    return Activity('review', item_type, rank, review.id, review.created_at, item.id, item.title,
+                    current_user.id, current_user.username, excerpt(review.content))
+
+def item_activity(item_type, item):
+    # new items rank after the review types at the same instant
+    rank = len(REVIEW_SOURCES) + list(CATALOGUE_MODELS).index(item_type)
+    return Activity('item', item_type, rank, item.id, datetime.utcnow(), item.id, item.title,
+                    current_user.id, current_user.username, excerpt(item.synopsis))
+
+def get_review_page(review_model, **item_filter):
+    # Newest reviews first, one page at a time, with every author loaded in a single extra IN query
+    # instead of one lazy User load per review card. (item_id, created_at) is indexed, so this is a range read.
+    query = review_model.query.filter_by(**item_filter).options(selectinload(review_model.user))
+    return compound_keyset_page(query, (review_model.created_at, review_model.id),
+                                page_size(request.args.get('limit'), app.config['REVIEWS_PAGE_SIZE']),
+                                after=request.args.get('after'), before=request.args.get('before'), descending=True)
+
+REVIEW_ACTIONS = re.compile(r'<!--review-actions (\d+) (\d+)-->')
+
+def bump_version(model, item_id):
+    # Every change to an item or its reviews moves it to a new version, retiring its cached fragments.
+    # Call before committing so the bump is part of the same transaction as the change.
+    model.query.filter_by(id=item_id).update({model.version: model.version + 1}, synchronize_session=False)
+
+def update_review_stats(item_model, review_model, item_id, delta):
+    # review_count / last_reviewed_at follow the review tables in the same UPDATE that moves the item to a new
+    # version (see bump_version). Call once the added or deleted review is flushed, before committing.
+    item_fk = getattr(review_model, f'{item_model.__tablename__}_id')
+    latest = select(func.max(review_model.created_at)).where(item_fk == item_id).scalar_subquery()
+    item_model.query.filter_by(id=item_id).update({
+        item_model.review_count: item_model.review_count + delta,
+        item_model.last_reviewed_at: latest,
+        item_model.version: item_model.version + 1,
+    }, synchronize_session=False)
+    bump_collection(f'{item_model.__tablename__}:reviews')
+
+def bump_collection(*names):
+    # Same idea as bump_version for listings and profiles, also called before committing
+    for name in names:
+        updated = CollectionVersion.query.filter_by(name=name).update(
+            {CollectionVersion.version: CollectionVersion.version + 1}, synchronize_session=False)
+        if not updated:
+            db.session.add(CollectionVersion(name=name, version=1))
+
+def collection_versions(*names):
+    # Current counters in the order asked for, 0 for a name that was never bumped
+    versions = dict(db.session.query(CollectionVersion.name, CollectionVersion.version)
+                    .filter(CollectionVersion.name.in_(names)))
+    return tuple(versions.get(name, 0) for name in names)
+
+def listing_etag(model):
+    # A listing changes when items are added, removed or get a new cover, and its order depends on the session's seed.
+    # Sorted by review activity it also changes with every review, counted under '<type>:reviews'.
+    if listing_sort():
+        return model.__tablename__, collection_versions(model.__tablename__, f'{model.__tablename__}:reviews')
+    if app.config['CATALOGUE_SHUFFLE'] and ('reshuffle' in request.args or 'shuffle_seed' not in session):
+        return None
+    return model.__tablename__, collection_versions(model.__tablename__), session.get('shuffle_seed')
+
+def item_etag(model, item_id):
+    # One primary key lookup of the version counter instead of loading the item and its reviews
+    version = db.session.query(model.version).filter_by(id=item_id).scalar()
+    if version is None:
+        return None  # let the view answer 404
+    # the "More like this" strip changes with `flask build-similar` and with its items' covers or deletion
+    return (model.__tablename__, item_id, version) + collection_versions('avatars', model.__tablename__,
+                                                                         f'{model.__tablename__}:similar')
+
+def profile_etag(user_id):
+    # Reviews by the user, their avatar and bio bump 'user:<id>'; removed items change the catalogue counters
+    return collection_versions(f'user:{user_id}', 'avatars', 'book', 'movie', 'game')
+
+def fill_review_actions(fragment, item_type, item_id):
+    # The cached review list looks the same to everyone, the delete buttons are added for the current user here
+    def actions(match):
+        review_id, author_id = int(match.group(1)), int(match.group(2))
+        if current_user.is_authenticated and (author_id == current_user.id or current_user.id == 1):
+            return render_template('review_actions.html', item_type=item_type, item_id=item_id, review_id=review_id)
+        return ''
+    return REVIEW_ACTIONS.sub(actions, fragment)
+
+def similar_items(model, item_id):
+    # One range read of the precomputed neighbours, joined to the items for their titles and covers
+    return (model.query.join(SimilarItem, model.id == SimilarItem.similar_id)
+            .filter(SimilarItem.item_type == model.__tablename__, SimilarItem.item_id == item_id)
+            .order_by(SimilarItem.position)
+            .limit(app.config['SIMILAR_COUNT'])
+            .all())
+
+def render_item_fragments(item_type, item, creator, review_model):
+    # Header and current page of reviews, served from the fragment cache while the item's version is unchanged.
+    # SQLite can give a deleted item's id to the next insert, starting again at version 1, so the key also
+    # carries '<type>:deleted', bumped by every delete of that type.
+    key = (item_type, item.id, item.version) + collection_versions('avatars', f'{item_type}:deleted')
+    header = fragment_cache.get_or_render(key + ('header',), lambda: render_template(
+        'item_header.html', item=item, item_type=item_type, creator=creator))
+
+    def review_list():
+        page = get_review_page(review_model, **{f'{item_type}_id': item.id})
+        return render_template('review_list.html', reviews=page.items, page=page, item=item, item_type=item_type)
+
+    page_args = tuple(request.args.get(arg, '') for arg in ('after', 'before', 'limit'))
+    reviews = fragment_cache.get_or_render(key + ('reviews',) + page_args, review_list)
+    return Markup(header), Markup(fill_review_actions(reviews, item_type, item.id))
 
 @app.route('/book/<int:book_id>')
+@conditional(lambda book_id: item_etag(Book, book_id))
 def book(book_id):
     form = ReviewForm()
     book = Book.query.get_or_404(book_id)
-    reviews = BookReview.query.filter_by(book_id=book_id).all()
-    return render_template('book.html', book=book, reviews=reviews, form=form)
+    item_header, review_list = render_item_fragments('book', book, book.author, BookReview)
+    return render_template('book.html', book=book, item_header=item_header, review_list=review_list, form=form,
+                           similar=similar_items(Book, book.id))
 
 @app.route('/movie/<int:movie_id>')
+@conditional(lambda movie_id: item_etag(Movie, movie_id))
 def movie(movie_id):
     form = ReviewForm()
     movie = Movie.query.get_or_404(movie_id)
-    reviews = MovieReview.query.filter_by(movie_id=movie_id).all()
-    return render_template('movie.html', movie=movie, reviews=reviews, form=form)
+    item_header, review_list = render_item_fragments('movie', movie, movie.director, MovieReview)
+    return render_template('movie.html', movie=movie, item_header=item_header, review_list=review_list, form=form,
+                           similar=similar_items(Movie, movie.id))
 
 @app.route('/game/<int:game_id>')
+@conditional(lambda game_id: item_etag(Game, game_id))
 def game(game_id):
     form = ReviewForm()
     game = Game.query.get_or_404(game_id)
-    reviews = GameReview.query.filter_by(game_id=game_id).all()
-    return render_template('game.html', game=game, reviews=reviews, form=form)
+    item_header, review_list = render_item_fragments('game', game, game.studio, GameReview)
+    return render_template('game.html', game=game, item_header=item_header, review_list=review_list, form=form,
+                           similar=similar_items(Game, game.id))
+
+@app.route('/search')
+def search():
+    # Ranked full-text search over titles, creators, genres and synopses, prefix matching every word
+    query = request.args.get('q', '').strip()
+    limit = app.config['SEARCH_PAGE_SIZE']
+    page_number = min(max(request.args.get('page', 1, type=int), 1), app.config['SEARCH_MAX_PAGES'])
+
+    hits = search_catalogue(db.session, query, limit + 1, (page_number - 1) * limit) if query else []
+    has_next = len(hits) > limit
+    hits = hits[:limit]
+
+    # fetch the matching rows with one IN query per item type, then put them back in rank order
+    found = {}
+    for item_type, model in CATALOGUE_MODELS.items():
+        ids = [item_id for hit_type, item_id in hits if hit_type == item_type]
+        if ids:
+            found.update({(item_type, item.id): item for item in model.query.filter(model.id.in_(ids))})
+    results = [(item_type, found[(item_type, item_id)]) for item_type, item_id in hits if (item_type, item_id) in found]
+
+    return render_template('search.html', query=query, results=results, page_number=page_number,
+                           has_next=has_next and page_number < app.config['SEARCH_MAX_PAGES'])
 
 @app.route('/add_review/<item_type>/<int:item_id>', methods=['GET', 'POST'])
 @login_required
@@ -154,7 +641,12 @@ def add_review(item_type, item_id):
         content = form.review_content.data
         new_review = review_model(content=content, user_id=current_user.id, **{f"{item_type}_id": item_id})
         db.session.add(new_review)
+        db.session.flush()
+        update_review_stats(item_model, review_model, item_id, 1)
+        bump_collection(f'user:{current_user.id}')
+        event = review_activity(item_type, item, new_review)
         db.session.commit()
+        activity_feed.add(event)
         
         # redirect user back to where they came from
         if review_model == BookReview:
@@ -166,6 +658,102 @@ def add_review(item_type, item_id):
 
     return redirect(url_for(item_type, item_id=item_id))
 
+def store_cover(stream):
+    # Cover stored under its content hash together with its card / detail sized variants, copied from
+    # the upload (or any open file) in chunks under the size limits
+    return store_upload(stream, os.path.join(app.config['UPLOAD_FOLDER'], 'covers'), COVER_SIZES,
+                        max_bytes=app.config['MAX_CONTENT_LENGTH'], max_pixels=app.config['MAX_IMAGE_PIXELS'])
+
+def store_avatar(stream):
+    return store_upload(stream, os.path.join(app.config['UPLOAD_FOLDER'], 'avatars'), AVATAR_SIZES,
+                        max_bytes=app.config['MAX_CONTENT_LENGTH'], max_pixels=app.config['MAX_IMAGE_PIXELS'])
+
+def image_error_message(error, what):
+    if isinstance(error, ImageTooLarge):
+        return f'The {what} is too large ({error}). Please upload a smaller image.'
+    return f'The {what} could not be read. Please upload a JPEG or PNG file.'
+
+def store_downloaded_cover(filename):
+    # Turn a cover the downloader left in the covers folder into its content-hashed variants. The download is
+    # removed whether or not it was a usable image; its .part name lets the image sweeper collect it if we crash first
+    path = os.path.join(app.config['UPLOAD_FOLDER'], 'covers', filename)
+    try:
+        with open(path, 'rb') as downloaded:
+            return store_cover(downloaded)
+    finally:
+        os.remove(path)
+
+def set_cover_image(model, item_id, filename):
+    # Runs on a cover downloader thread once the image is on disk: build the variants and point the item at them
+    cover_image_filename = store_downloaded_cover(filename)
+    with app.app_context():
+        model.query.filter_by(id=item_id).update({'cover_image': cover_image_filename})
+        bump_version(model, item_id)
+        bump_collection(model.__tablename__)
+        db.session.commit()
+
+def images_in_use(models, column):
+    # Runs on the sweeper thread, hence the app context
+    with app.app_context():
+        return {name for model in models for (name,) in db.session.query(getattr(model, column)).distinct()}
+
+image_sweeper = ImageSweeper([
+    (os.path.join(app.config['UPLOAD_FOLDER'], 'covers'), partial(images_in_use, CATALOGUE_MODELS.values(), 'cover_image')),
+    (os.path.join(app.config['UPLOAD_FOLDER'], 'avatars'), partial(images_in_use, [User], 'avatar')),
+], grace=app.config['IMAGE_SWEEP_GRACE'])
+
+def delete_items(item_type, ids):
+    # Deletes items together with their reviews and genre links in one transaction, with a few set based DELETEs instead of one
+    # per row, and returns how many items were removed. The search index follows through its triggers, covers
+    # nobody uses any more are removed afterwards by the image sweeper.
+    model = CATALOGUE_MODELS[item_type]
+    _, review_model, _, item_fk = next(source for source in REVIEW_SOURCES if source[0] == item_type)
+    ids = sorted(set(ids))
+    batch_size = app.config['DELETE_BATCH_SIZE']
+    deleted = 0
+    authors = set()
+    for start in range(0, len(ids), batch_size):
+        batch = ids[start:start + batch_size]
+        authors.update(user_id for (user_id,) in db.session.query(review_model.user_id).filter(item_fk.in_(batch)).distinct())
+        unlink_genres(db.session.connection(), item_type, batch)
+        review_model.query.filter(item_fk.in_(batch)).delete(synchronize_session=False)
+        deleted += model.query.filter(model.id.in_(batch)).delete(synchronize_session=False)
+        SimilarItem.query.filter(SimilarItem.item_type == item_type,
+                                 SimilarItem.item_id.in_(batch) | SimilarItem.similar_id.in_(batch)
+                                 ).delete(synchronize_session=False)
+    # the listings, the review sorted listings and the profiles that showed these reviews all change, and
+    # fragments cached under these ids must not be shown for new items that get the same ids
+    bump_collection(item_type, f'{item_type}:reviews', f'{item_type}:deleted',
+                    *[f'user:{user_id}' for user_id in sorted(authors)])
+    db.session.commit()
+
+    for item_id in ids:
+        featured_sampler.remove(model, item_id)
+    # the counter above already keeps them from being shown, this frees the space (other workers' memory caches age them out)
+    fragment_cache.forget([(item_type, item_id) for item_id in ids])
+    removed = set(ids)
+    activity_feed.remove(lambda event: event.item_type == item_type and event.item_id in removed)
+    image_sweeper.request()
+    return deleted
+
+def looked_up_cover(lookup, identifier):
+    # The cover URL found by a lookup earlier in this session. Only the ISBN / IMDB id is kept in the session
+    # cookie, the URL is read again from the metadata cache so the client never gets to choose what is downloaded
+    if not identifier:
+        return None
+    try:
+        return lookup(identifier)['cover_url']
+    except MetadataError:
+        return None
+
+def queue_cover_download(model, item, cover_url):
+    # The item keeps the default cover until the background download finishes
+    filename = f'{model.__tablename__}_{item.id}_download.part'
+    if cover_downloader.submit(cover_url, filename, on_done=partial(set_cover_image, model, item.id)):
+        flash('The cover is being downloaded and will appear shortly.', 'info')
+    else:
+        flash('Too many covers are being downloaded right now, the default cover is shown instead.', 'warning')
+
 @app.route('/add', methods=['GET', 'POST'])
 @login_required
 def add():
@@ -180,59 +768,46 @@ def add_book():
     if isbn_form.validate_on_submit():
         flash('ISBN form submitted', 'info')
         isbn = isbn_form.isbn.data
-        api_url = f'https://openlibrary.org/api/books?bibkeys=ISBN:{isbn}&jscmd=data&format=json'
-        response = requests.get(api_url)
-
-        if response.status_code == 200:
-            book_data = response.json().get(f'ISBN:{isbn}')
-        
-            if book_data:
-                # Extract book details from the Open Library API response
-                form.title.data = book_data.get('title', '')
-                authors = [author.get('name', '') for author in book_data.get('authors', [])]
-                form.author.data = ', '.join(authors)
-                # Extract subject and excerpts from the list of dictionaries
-                genres = [subject.get('name', '') for subject in book_data.get('subjects', [])[:3]]
-                form.genre.data = ', '.join(genres)
-                synopses = [excerpt.get('text', '') for excerpt in book_data.get('excerpts', [])]
-                form.synopsis.data = ', '.join(synopses)
-                # Extract cover image
-                cover_url = book_data.get('cover', {}).get('medium')
-                if cover_url: # If cover image is available
-                    flash(f'Book details fetched successfully. ISBN: {isbn}', 'success')
-                    response = requests.get(cover_url)
-                    if response.status_code == 200: # If the link can be accessed
-                        flash('Book cover submitted', 'info')
-                        cover_image_filename = f'{secure_filename(form.title.data.replace(" ", "_"))}_cover.jpg'
-                        invalid_chars = r'<>:"/\|?*'
-                        for char in invalid_chars: # make sure the filename does not consist of illegal chars
-                            cover_image_filename = cover_image_filename.replace(char, "")
-                        cover_image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'covers', cover_image_filename)
-                        with open(cover_image_path, 'wb') as img_file:
-                            img_file.write(response.content) # write the image to the server on the path
-                    return render_template('add_book.html', isbn_form=isbn_form, form=form, cover_url=cover_url)
-                else:
-                    flash(f'Book details fetched successfully. ISBN: {isbn} (No thumbnail available)', 'success')
-                    return render_template('add_book.html', isbn_form=isbn_form, form=form)
-            else:
-                flash(f'No book details found for ISBN: {isbn}. Please enter the details manually.', 'warning')
-        else:
+        try:
+            book_data = metadata_client.lookup_isbn(isbn)
+        except MetadataNotFound:
+            flash(f'No book details found for ISBN: {isbn}. Please enter the details manually.', 'warning')
+        except MetadataError:
             flash('Error fetching book details. Please try again.', 'danger')
+        else:
+            # Fill the form with the book details from Open Library
+            form.title.data = book_data['title']
+            form.author.data = book_data['author']
+            form.genre.data = book_data['genre']
+            form.synopsis.data = book_data['synopsis']
+            cover_url = book_data['cover_url']
+            if cover_url: # If cover image is available
+                flash(f'Book details fetched successfully. ISBN: {isbn}', 'success')
+                # Remember which ISBN was looked up, the cover is downloaded in the background once the book is added
+                session['pending_book_lookup'] = isbn
+                return render_template('add_book.html', isbn_form=isbn_form, form=form, cover_url=cover_url)
+            else:
+                flash(f'Book details fetched successfully. ISBN: {isbn} (No thumbnail available)', 'success')
+                return render_template('add_book.html', isbn_form=isbn_form, form=form)
 
     if form.validate_on_submit():
         flash('Book details form submitted', 'info')
         cover_image_filename = None
 
+        pending_cover = looked_up_cover(metadata_client.lookup_isbn, session.pop('pending_book_lookup', None))
+
         if form.cover_image.data:
             # Cover image uploaded by the user
-            cover_image = form.cover_image.data
-            cover_image_filename = secure_filename(cover_image.filename)
-            cover_image_filename = f'{form.title.data.replace(" ", "_")}_cover.jpg'
-            invalid_chars = r'<>:"/\|?*'
-            for char in invalid_chars:
-                cover_image_filename = cover_image_filename.replace(char, "")
-            cover_image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'covers', cover_image_filename)
-            cover_image.save(cover_image_path)
+            pending_cover = None
+            try:
+                cover_image_filename = store_cover(form.cover_image.data)
+            except ImageError as error:
+                flash(image_error_message(error, 'cover image'), 'danger')
+                return redirect(url_for('add_book'))
+
+        elif pending_cover:
+            # Cover found by the lookup, show the default one until the download is done
+            cover_image_filename = 'default_cover.png'
 
         else: # Cover image not uploaded, check if downloaded from Open Library or otherwise
             cover_image_filename = f'{form.title.data.replace(" ", "_")}_cover.jpg'
@@ -257,7 +832,15 @@ def add_book():
 
         # Add the new book to the database
         db.session.add(new_book)
+        db.session.flush()
+        link_genres(db.session.connection(), 'book', [(new_book.id, new_book.genre)])
+        bump_collection('book')
+        event = item_activity('book', new_book)
         db.session.commit()
+        featured_sampler.add(Book, new_book.id)
+        activity_feed.add(event)
+        if pending_cover:
+            queue_cover_download(Book, new_book, pending_cover)
 
         flash('Book added successfully!', 'success')
         return redirect(url_for('index'))
@@ -273,57 +856,47 @@ def add_movie():
     if imdb_form.validate_on_submit():
         flash('IMDB form submitted', 'info')
         imdb = imdb_form.imdb.data
-        api_url = f'http://www.omdbapi.com/?i={imdb}&apikey=8d437aa0'
-        response = requests.get(api_url)
-
-        if response.status_code == 200:
-            movie_data = response.json()
-
-            if movie_data.get('Response') == 'True':
-                # Extract movie details from the OMDB API response
-                form.title.data = movie_data.get('Title', '')
-                form.director.data = movie_data.get('Director', '')
-                form.genre.data = movie_data.get('Genre', '')
-                form.synopsis.data = movie_data.get('Plot', '')
-                form.cover_image.data = movie_data.get('Poster', '')
-                # The code below is virtually identical to the add_book route
-                if form.cover_image.data:
-                    response_cover = requests.get(form.cover_image.data)
-                    if response_cover.status_code == 200:
-                        cover_image_filename = f'{secure_filename(form.title.data.replace(" ", "_"))}_cover.jpg'
-                        invalid_chars = r'<>:"/\|?*'
-                        for char in invalid_chars:
-                            cover_image_filename = cover_image_filename.replace(char, "")
-                        cover_image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'covers', cover_image_filename)
-                        with open(cover_image_path, 'wb') as img_file:
-                            img_file.write(response_cover.content)
-                        flash('Movie details and cover fetched successfully.', 'success')
-                        return render_template('add_movie.html', imdb_form=imdb_form, form=form)
-                    else:
-                        flash('Error downloading movie cover. Please try again.', 'danger')
-                else:
-                    flash('Movie details fetched successfully. No cover found.', 'success')
-                    return render_template('add_movie.html', imdb_form=imdb_form, form=form)
-            else:
-                flash(f'Error: {movie_data.get("Error")}', 'danger')
-        else:
+        try:
+            movie_data = metadata_client.lookup_imdb(imdb)
+        except MetadataNotFound as error:
+            flash(f'Error: {error}', 'danger')
+        except MetadataError:
             flash('Error fetching movie details. Please try again.', 'danger')
+        else:
+            # Fill the form with the movie details from OMDB
+            form.title.data = movie_data['title']
+            form.director.data = movie_data['director']
+            form.genre.data = movie_data['genre']
+            form.synopsis.data = movie_data['synopsis']
+            cover_url = movie_data['cover_url']
+            # The code below is virtually identical to the add_book route
+            if cover_url:
+                session['pending_movie_lookup'] = imdb
+                flash('Movie details and cover fetched successfully.', 'success')
+                return render_template('add_movie.html', imdb_form=imdb_form, form=form, cover_url=cover_url)
+            else:
+                flash('Movie details fetched successfully. No cover found.', 'success')
+                return render_template('add_movie.html', imdb_form=imdb_form, form=form)
 
     if form.validate_on_submit():
         # This is identical to the add_book route
         flash('Movie details form submitted', 'info')
         cover_image_filename = None
 
+        pending_cover = looked_up_cover(metadata_client.lookup_imdb, session.pop('pending_movie_lookup', None))
+
         if form.cover_image.data:
             # Cover image uploaded by the user
-            cover_image = form.cover_image.data
-            cover_image_filename = secure_filename(cover_image.filename)
-            cover_image_filename = f'{form.title.data.replace(" ", "_")}_cover.jpg'
-            invalid_chars = r'<>:"/\|?*'
-            for char in invalid_chars:
-                cover_image_filename = cover_image_filename.replace(char, "")
-            cover_image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'covers', cover_image_filename)
-            cover_image.save(cover_image_path)
+            pending_cover = None
+            try:
+                cover_image_filename = store_cover(form.cover_image.data)
+            except ImageError as error:
+                flash(image_error_message(error, 'cover image'), 'danger')
+                return redirect(url_for('add_movie'))
+
+        elif pending_cover:
+            # Cover found by the lookup, show the default one until the download is done
+            cover_image_filename = 'default_cover.png'
 
         else:
             cover_image_filename = f'{form.title.data.replace(" ", "_")}_cover.jpg'
@@ -349,7 +922,15 @@ def add_movie():
 
         # Add the new movie to the database
         db.session.add(new_movie)
+        db.session.flush()
+        link_genres(db.session.connection(), 'movie', [(new_movie.id, new_movie.genre)])
+        bump_collection('movie')
+        event = item_activity('movie', new_movie)
         db.session.commit()
+        featured_sampler.add(Movie, new_movie.id)
+        activity_feed.add(event)
+        if pending_cover:
+            queue_cover_download(Movie, new_movie, pending_cover)
 
         flash('Movie added successfully!', 'success')
         return redirect(url_for('index'))
@@ -367,14 +948,11 @@ def add_game():
 
         if form.cover_image.data:
             # Cover image uploaded by the user
-            cover_image = form.cover_image.data
-            cover_image_filename = secure_filename(cover_image.filename)
-            cover_image_filename = f'{form.title.data.replace(" ", "_")}_cover.jpg'
-            invalid_chars = r'<>:"/\|?*'
-            for char in invalid_chars:
-                cover_image_filename = cover_image_filename.replace(char, "")
-            cover_image_path = os.path.join(app.config['UPLOAD_FOLDER'], 'covers', cover_image_filename)
-            cover_image.save(cover_image_path)
+            try:
+                cover_image_filename = store_cover(form.cover_image.data)
+            except ImageError as error:
+                flash(image_error_message(error, 'cover image'), 'danger')
+                return redirect(url_for('add_game'))
 
         else:
             cover_image_filename = f'{form.title.data.replace(" ", "_")}_cover.jpg'
@@ -401,7 +979,13 @@ def add_game():
 
         # Add the new game to the database
         db.session.add(new_game)
+        db.session.flush()
+        link_genres(db.session.connection(), 'game', [(new_game.id, new_game.genre)])
+        bump_collection('game')
+        event = item_activity('game', new_game)
         db.session.commit()
+        featured_sampler.add(Game, new_game.id)
+        activity_feed.add(event)
 
         flash('Game added successfully!', 'success')
         return redirect(url_for('index'))
@@ -412,15 +996,37 @@ def add_game():
 def login():
     form = LoginForm()
 
-    if request.method == 'POST':
+    if form.validate_on_submit():
+        # Refused before the database or the hasher are touched while there are too many recent failures
+        retry_after = login_limiter.retry_after(form.username.data, request.remote_addr)
+        if retry_after:
+            flash(f'Too many failed logins. Please try again in {math.ceil(retry_after / 60)} minutes.', 'danger')
+            return render_template('login.html', form=form), 429, {'Retry-After': str(math.ceil(retry_after))}
+
         # Check if the user exists
-        user = User.query.filter_by(username=request.form['username']).first()
-        if user and check_password_hash(user.password, request.form['password']):
+        user = User.query.filter_by(username=form.username.data).first()
+        try:
+            valid = user is not None and password_hasher.verify(user.password, form.password.data)
+        except HasherBusy:
+            flash('Too many people are logging in right now. Please try again in a moment.', 'danger')
+            return render_template('login.html', form=form), 503, {'Retry-After': '5'}
+        if valid and password_hasher.needs_rehash(user.password):
+            # hashed with older parameters, replaced now that the password is known (or at a later login when busy)
+            try:
+                user.password = password_hasher.hash(form.password.data)
+                db.session.commit()
+            except HasherBusy:
+                pass
+
+        if valid:
             # Log in the user
+            login_limiter.succeeded(form.username.data)
             login_user(user)
+            renew_identity_stamp(user.id)
             flash('Login successful!', 'success')
             return redirect(url_for('index'))
         else:
+            login_limiter.failed(form.username.data, request.remote_addr)
             flash('Login failed. Please check your username and password.', 'danger')
             return redirect(url_for('index'))
 
@@ -430,6 +1036,7 @@ def login():
 @login_required
 def logout():
     # Log out the user
+    identity_cache.invalidate(current_user.id)
     logout_user()
     session.clear()
     flash('You have been logged out.', 'success')
@@ -450,7 +1057,11 @@ def register():
             return redirect(url_for('index'))
 
         # Create a new user
-        hashed_password = generate_password_hash(form.password.data, method="pbkdf2", salt_length=16)
+        try:
+            hashed_password = password_hasher.hash(form.password.data)
+        except HasherBusy:
+            flash('The site is busy right now. Please try again in a moment.', 'danger')
+            return render_template('register.html', form=form), 503, {'Retry-After': '5'}
         user = User(username=form.username.data, password=hashed_password)
 
         # Add the new user to the database
@@ -471,36 +1082,40 @@ def user_profile():
     if form.validate_on_submit():
         # Save avatar
         if form.avatar.data:
-            avatar = form.avatar.data
-            avatar_filename = secure_filename(avatar.filename)
-            avatar_path = os.path.join(app.config['UPLOAD_FOLDER'], 'avatars', avatar_filename)
-            avatar.save(avatar_path)
-            current_user.avatar = avatar_filename
+            # Stored under its content hash, so users uploading files with the same name no longer overwrite each other
+            try:
+                current_user.avatar = store_avatar(form.avatar.data)
+            except ImageError as error:
+                flash(image_error_message(error, 'avatar'), 'danger')
+                return redirect(url_for('user_profile'))
 
         # Update user bio
         current_user.bio = form.bio.data
+        bump_collection(f'user:{current_user.id}')
+        if form.avatar.data:
+            bump_collection('avatars')
 
         # Save changes to the database
         db.session.commit()
+        renew_identity_stamp(current_user.id)
         flash('Profile updated successfully!', 'success')
         return redirect(url_for('user_profile'))
 
     form.bio.data = current_user.bio
-    all_reviews = current_user.book_reviews + current_user.game_reviews + current_user.movie_reviews
-    reviews = sorted(all_reviews, key=lambda review: review.id, reverse=True) # This sorts the user's reviews by ID
+    page = get_timeline_page(current_user.id)
 
-    return render_template('user_profile.html', form=form, reviews=reviews)
+    return render_template('user_profile.html', form=form, reviews=page.items, page=page)
 
 @app.route('/profile/<int:user_id>')
+@conditional(profile_etag)
 def profile(user_id):
     # This route is for the public profile
     user = User.query.get_or_404(user_id)
     
-    # Combine all reviews and order them by timestamp
-    all_reviews = user.book_reviews + user.game_reviews + user.movie_reviews
-    reviews = sorted(all_reviews, key=lambda review: review.id, reverse=True)
-    
-    return render_template('profile.html', user=user, reviews=reviews)
+    # Combine all reviews and order them in the database, newest first
+    page = get_timeline_page(user.id)
+
+    return render_template('profile.html', user=user, reviews=page.items, page=page)
 
 @app.route('/delete_review/<string:item_type>/<int:item_id>/<int:review_id>', methods=['POST'])
 @login_required
@@ -523,7 +1138,11 @@ def delete_review(item_type, item_id, review_id):
     # Check if the current user is the author of the review
     if review.user_id == current_user.id or current_user.id == 1:
         db.session.delete(review)
+        db.session.flush()
+        update_review_stats(CATALOGUE_MODELS[item_type], review_model, getattr(review, f'{item_type}_id'), -1)
+        bump_collection(f'user:{review.user_id}')
         db.session.commit()
+        activity_feed.remove(lambda event: event.kind == 'review' and event.item_type == item_type and event.id == review_id)
         flash('Review deleted successfully!', 'success')
 
     # Redirect back to the item page
@@ -538,28 +1157,180 @@ def delete_review(item_type, item_id, review_id):
 @login_required
 def delete_entry(item_type, item_id):
     # This route allows for the deletion of books / movies / games by an administrator, checked using user id
-    model = None
-
-    # Determine the model based on the item_type
-    if item_type == 'book':
-        model = Book
-    elif item_type == 'movie':
-        model = Movie
-    elif item_type == 'game':
-        model = Game
-    else:
+    if item_type not in CATALOGUE_MODELS:
         flash('Invalid item type.', 'danger')
         return redirect(url_for('index'))
 
-    entry = model.query.get_or_404(item_id)
+    CATALOGUE_MODELS[item_type].query.get_or_404(item_id)
 
     # Check if the current user is administrator
     if current_user.id == 1:
-        db.session.delete(entry)
-        db.session.commit()
+        # its reviews go with it
+        delete_items(item_type, [item_id])
         flash('Entry deleted successfully!', 'success')
 
-    return render_template('index.html')
+    return redirect(url_for('index'))
+
+@app.route('/admin/delete/<any(book, movie, game):item_type>', methods=['POST'])
+@login_required
+def bulk_delete(item_type):
+    # Delete many items at once: POST {"ids": [1, 2, 3]} as JSON. Only JSON is accepted, which a form on
+    # another site cannot send, so this needs no CSRF token.
+    if current_user.id != 1:
+        abort(404)
+    payload = request.get_json(silent=True) if request.is_json else None
+    ids = payload.get('ids') if isinstance(payload, dict) else None
+    if not isinstance(ids, list) or not all(type(item_id) is int for item_id in ids):
+        return jsonify(error='expected a JSON body like {"ids": [1, 2, 3]}'), 400
+    deleted = delete_items(item_type, ids)
+    return jsonify(requested=len(set(ids)), deleted=deleted)
+
+# Public fields of each /api/ resource, in output order, id first
+API_FIELDS = {
+    'books': (Book, ('id', 'title', 'author', 'genre', 'synopsis', 'cover_image', 'review_count', 'last_reviewed_at')),
+    'movies': (Movie, ('id', 'title', 'director', 'genre', 'synopsis', 'cover_image', 'review_count', 'last_reviewed_at')),
+    'games': (Game, ('id', 'title', 'studio', 'genre', 'synopsis', 'cover_image', 'review_count', 'last_reviewed_at')),
+    'users': (User, ('id', 'username', 'bio', 'avatar')),
+}
+
+@app.route('/api/<any(books, movies, games, users):resource>')
+def api_table(resource):
+    # Read-only streaming export, see api.py for the parameters
+    model, fields = API_FIELDS[resource]
+    columns = {field: getattr(model, field) for field in fields}
+    return stream_table(model.query, columns, app.config['API_MAX_ROWS'], app.config['API_BATCH_SIZE'])
+
+@app.route('/api/reviews/<any(book, movie, game):item_type>')
+def api_reviews(item_type):
+    # Reviews of one item type, optionally only those of ?item_id= or ?user_id= (both indexed)
+    _, review_model, _, item_fk = next(source for source in REVIEW_SOURCES if source[0] == item_type)
+    columns = {'id': review_model.id, 'item_id': item_fk, 'user_id': review_model.user_id,
+               'content': review_model.content, 'created_at': review_model.created_at}
+    query = review_model.query
+    for arg, column in (('item_id', item_fk), ('user_id', review_model.user_id)):
+        if request.args.get(arg, type=int) is not None:
+            query = query.filter(column == request.args.get(arg, type=int))
+    return stream_table(query, columns, app.config['API_MAX_ROWS'], app.config['API_BATCH_SIZE'])
+
+@app.route('/activity')
+def activity():
+    # Served from the in-memory buffer, pages further back than it reaches are read from the review tables
+    page = activity_feed.page(page_size(request.args.get('limit'), app.config['REVIEWS_PAGE_SIZE']),
+                              after=request.args.get('after'))
+    return render_template('activity.html', activity=page.items, page=page)
+
+@app.route('/activity/poll')
+def activity_poll():
+    # Long poll for live updates: returns the events newer than ?since=<cursor> as soon as there are any, or an
+    # empty list after ACTIVITY_POLL_TIMEOUT seconds. Without ?since only the newest event is returned, whose
+    # cursor starts the polling. The database connection goes back to the pool before the wait.
+    activity_feed.latest(1)
+    db.session.close()
+    events = activity_feed.wait(request.args.get('since'), app.config['ACTIVITY_POLL_TIMEOUT'])
+    return jsonify(events=[dict(event._asdict(), created_at=event.created_at.isoformat(),
+                                url=url_for(event.item_type, **{f'{event.item_type}_id': event.item_id}),
+                                cursor=encode_timeline_cursor(event)) for event in events],
+                   latest=encode_timeline_cursor(events[-1]) if events else request.args.get('since'))
+
+@app.route('/admin/timings')
+@login_required
+def admin_timings():
+    # Per-endpoint latency histograms collected by this worker process since it started, administrator only
+    if current_user.id != 1 or not instrumentation.enabled:
+        abort(404)
+    if request.args.get('reset'):
+        instrumentation.reset()
+    return jsonify(instrumentation.snapshot())
+
+@app.cli.command('build-images')
+def build_images():
+    # Move covers and avatars saved under their old title / upload names to content-hashed files with variants,
+    # and add the full-size WebP to hashed images stored before it was made
+    converted = added = 0
+    for model, column, store, folder in ((Book, 'cover_image', store_cover, 'covers'),
+                                         (Movie, 'cover_image', store_cover, 'covers'),
+                                         (Game, 'cover_image', store_cover, 'covers'),
+                                         (User, 'avatar', store_avatar, 'avatars')):
+        for row in model.query.all():
+            filename = getattr(row, column)
+            path = os.path.join(app.config['UPLOAD_FOLDER'], folder, filename or '')
+            if not filename or filename.startswith('default_') or not os.path.isfile(path):
+                continue
+            if hashed_image(filename):
+                try:
+                    added += add_missing_webp(os.path.dirname(path), filename)
+                except ImageError:
+                    print(f'Skipped unreadable image {path}')
+                continue
+            try:
+                with open(path, 'rb') as image_file:
+                    setattr(row, column, store(image_file))
+                if model is not User:
+                    row.version += 1
+            except ImageError:
+                print(f'Skipped unreadable image {path}')
+                continue
+            converted += 1
+        bump_collection(model.__tablename__ if model is not User else 'avatars')
+        db.session.commit()
+    print(f'Converted {converted} images, added {added} full-size WebP images.')
+
+@app.cli.command('reconcile-counters')
+def reconcile_counters():
+    # Recount reviews per item, e.g. after importing reviews or editing the database by hand: flask reconcile-counters
+    fixed = reconcile_review_counters(db.session.connection())
+    # sorted listings built from the old counts are stale now
+    bump_collection(*[f'{table}:reviews' for table, rows in fixed.items() if rows])
+    db.session.commit()
+    print(', '.join(f'{table}: {rows} fixed' for table, rows in fixed.items()))
+
+@app.cli.command('backfill-genres')
+def backfill_genres_command():
+    # Link items written straight to the database (generate_dataset.py, manual fixes) to their genres and recount
+    linked = backfill_genres(db.session.connection())
+    bump_collection(*CATALOGUE_MODELS)
+    db.session.commit()
+    print(', '.join(f'{item_type}: {links} genre links added' for item_type, links in linked.items()))
+
+@app.cli.command('sweep-images')
+def sweep_images():
+    # Remove covers and avatars no longer used by any row, e.g. from cron: flask sweep-images
+    print(f'Removed {image_sweeper.sweep()} unused image files.')
+
+@app.cli.command('build-similar')
+@click.option('--full', is_flag=True, help='Recompute every item instead of those added or reviewed since the last run.')
+def build_similar(full):
+    # Refresh the "More like this" neighbours, e.g. nightly from cron: flask build-similar
+    from similar import refresh_similar  # numpy / scipy are only needed here, not in the web workers
+    for item_type in CATALOGUE_MODELS:
+        refreshed = refresh_similar(db.session.connection(), item_type, k=app.config['SIMILAR_KEEP'],
+                                    text_weight=app.config['SIMILAR_TEXT_WEIGHT'], full=full)
+        if refreshed:
+            bump_collection(f'{item_type}:similar')
+        db.session.commit()
+        print(f'{item_type}: {refreshed} lists refreshed')
+
+@app.cli.command('rebuild-search')
+def rebuild_search():
+    # Re-index every book, movie and game, e.g. after restoring an old database: flask rebuild-search
+    with db.engine.begin() as conn:
+        rebuild_search_index(conn)
+    print('Search index rebuilt.')
+
+@app.after_request
+def cache_hashed_images(response):
+    # Content-hashed images and fingerprinted static files never change under the same name, so they can be cached without revalidation
+    filename = (request.view_args or {}).get('filename', '')
+    if request.endpoint == 'static' and response.status_code in (200, 304) \
+            and (is_content_addressed(os.path.basename(filename)) or static_assets.find(filename)):
+        response.headers['Cache-Control'] = f'public, max-age={app.config["IMMUTABLE_MAX_AGE"]}, immutable'
+    return response
+
+@app.errorhandler(413)
+def request_too_large(error):
+    # Refused from its Content-Length before the body is read; back to the form with a message instead of a bare error
+    flash(f'Uploads can be at most {app.config["MAX_CONTENT_LENGTH"] // (1024 * 1024)} MB.', 'danger')
+    return redirect(request.path)
 
 @app.errorhandler(404)
 def page_not_found(error):
@@ -0,0 +1,97 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+import tempfile
+from collections import namedtuple
+
+try:
+    import brotli
+except ImportError:  # in requirements.txt, without it only gzip copies are made
+    brotli = None
+
+# Fingerprinted static files: at startup every file under static/ (apart from the uploaded, already content
+# addressed covers and avatars) is hashed, and url_for('static', filename='css/style.css') is rewritten to
+# css/style.<hash>.css. A fingerprinted URL always means the same bytes, so it can be cached for a year
+# without revalidation, and a changed file gets a new URL. Text files also get brotli and gzip copies,
+# written once into the build folder and sent as they are to browsers that accept them instead of being
+# compressed per request. Copies left by an earlier start (or another worker) are reused, not made again.
+
+COMPRESSIBLE = {'.css', '.js', '.json', '.map', '.svg', '.txt', '.html', '.ico'}
+MIN_COMPRESS_SIZE = 512  # smaller files gain less than the Content-Encoding header costs
+
+Asset = namedtuple('Asset', ['path', 'mimetype', 'encodings'])  # encodings: [(encoding, path)], best first
+
+
+def fingerprinted_name(filename, digest):
+    root, extension = os.path.splitext(filename)
+    return f'{root}.{digest}{extension}'
+
+
+def _write_once(path, data):
+    # Compressed copies are named after the content hash, an existing one is already right
+    if os.path.exists(path):
+        return
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    with os.fdopen(handle, 'wb') as temp_file:
+        temp_file.write(data)
+    os.replace(temp_path, path)
+
+
+class StaticAssets:
+    def __init__(self, static_folder, build_folder, exclude=()):
+        self.static_folder = static_folder
+        self.build_folder = build_folder
+        self.exclude = [os.path.abspath(path) for path in (build_folder, *exclude)]
+        self.manifest = {}  # 'css/style.css' -> 'css/style.<hash>.css'
+        self._assets = {}  # fingerprinted name -> Asset
+
+    def build(self):
+        # Hashes and compresses every static file, returns how many were fingerprinted
+        manifest, assets = {}, {}
+        for directory, subdirectories, filenames in os.walk(self.static_folder):
+            subdirectories[:] = [name for name in subdirectories
+                                 if os.path.abspath(os.path.join(directory, name)) not in self.exclude]
+            for name in filenames:
+                path = os.path.join(directory, name)
+                filename = os.path.relpath(path, self.static_folder).replace(os.sep, '/')
+                with open(path, 'rb') as static_file:
+                    data = static_file.read()
+                hashed = fingerprinted_name(filename, hashlib.sha256(data).hexdigest()[:12])
+                manifest[filename] = hashed
+                assets[hashed] = Asset(path, mimetypes.guess_type(name)[0] or 'application/octet-stream',
+                                       self._compress(hashed, data))
+        self.manifest, self._assets = manifest, assets
+        return len(manifest)
+
+    def _compress(self, hashed, data):
+        # Copies already in the build folder are used as they are, only missing ones are compressed
+        if os.path.splitext(hashed)[1] not in COMPRESSIBLE or len(data) < MIN_COMPRESS_SIZE:
+            return []
+        compressors = [('br', 'br', lambda: brotli.compress(data, quality=11))] if brotli is not None else []
+        compressors.append(('gzip', 'gz', lambda: gzip.compress(data, compresslevel=9, mtime=0)))
+        variants = []
+        for encoding, extension, compress in compressors:
+            path = os.path.join(self.build_folder, f'{hashed}.{extension}')
+            if not os.path.exists(path):
+                compressed = compress()
+                if len(compressed) >= len(data):
+                    continue
+                _write_once(path, compressed)
+            variants.append((encoding, path))
+        return variants
+
+    def url_filename(self, filename):
+        return self.manifest.get(filename, filename)
+
+    def find(self, filename):
+        # the Asset behind a fingerprinted name, or None for anything else
+        return self._assets.get(filename)
+
+    def choose(self, asset, accept_encodings):
+        # (Content-Encoding or None, path to send) for a request's Accept-Encoding
+        for encoding, path in asset.encodings:
+            if accept_encodings[encoding]:
+                return encoding, path
+        return None, asset.path
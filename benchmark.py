@@ -0,0 +1,258 @@
+import argparse
+import json
+import random
+import re
+import statistics
+import threading
+import time
+import tracemalloc
+from datetime import datetime
+
+from sqlalchemy import event, func
+
+from database import engine_options
+from app import CATALOGUE_MODELS, User, app, db, fragment_cache, password_hasher
+from generate_dataset import skewed_id
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+# Drive every page through the Flask test client against a generated database and report latency
+# percentiles, queries per request and memory per route.
+#
+#   python generate_dataset.py --database sqlite:///benchmark.db
+#   python benchmark.py --database sqlite:///benchmark.db --requests 500 --output results.json
+#
+# Detail pages and profiles are picked with the same skewed popularity the generator uses, listings
+# are paged through by following their "next" links. add_review writes to the database it runs against.
+#
+# --login-load measures a page while other threads log in as fast as they can, against the same page
+# measured alone, to show what a burst of logins costs everyone else and how many logins go through.
+
+NEXT_CURSOR = re.compile(r'[?&]after=([^"&]+)')
+
+
+def percentile(samples, share):
+    # nearest rank, fine for the few hundred samples per route a run takes
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * share), len(ordered) - 1)]
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class Scenario:
+    # builds the next request for each route: (method, url, form data)
+
+    def __init__(self, rng, counts, user_count, skew=3.0):
+        self.rng = rng
+        self.counts = counts
+        self.user_count = user_count
+        self.skew = skew
+        self.cursors = {}
+        self.listings = {f'{item_type}s' for item_type in counts}
+
+    def popular(self, count):
+        return skewed_id(self.rng, count, self.skew)
+
+    def active_user(self):
+        # generate_dataset draws review authors with half the skew, so these are the profiles with the most reviews
+        return skewed_id(self.rng, self.user_count, self.skew / 2 + 0.5)
+
+    def routes(self):
+        routes = {'index': lambda: ('GET', '/', None)}
+        for item_type, count in self.counts.items():
+            listing = f'{item_type}s'
+            routes[listing] = lambda listing=listing: self.listing(listing)
+            routes[item_type] = lambda item_type=item_type, count=count: (
+                'GET', f'/{item_type}/{self.popular(count)}', None)
+        routes['profile'] = lambda: ('GET', f'/profile/{self.active_user()}', None)
+        routes['search'] = lambda: ('GET', f'/search?q={self.rng.choice(("star", "void echo", "nebula", "iron tide"))}', None)
+        routes['add_review'] = self.add_review
+        return routes
+
+    def listing(self, listing):
+        cursor = self.cursors.get(listing)
+        return 'GET', f'/{listing}' + (f'?after={cursor}' if cursor else ''), None
+
+    def add_review(self):
+        item_type = self.rng.choice(list(self.counts))
+        item_id = self.popular(self.counts[item_type])
+        return 'POST', f'/add_review/{item_type}/{item_id}', {'review_content': 'Benchmark review, ' * 3}
+
+    def record(self, route, response):
+        # listings continue from the page just shown, starting over after the last one
+        if route in self.listings:
+            match = NEXT_CURSOR.search(response.get_data(as_text=True))
+            self.cursors[route] = match.group(1) if match else None
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    with app.app_context():
+        counts = {item_type: db.session.query(func.max(model.id)).scalar() or 0
+                  for item_type, model in CATALOGUE_MODELS.items()}
+        user_count = db.session.query(func.max(User.id)).scalar() or 0
+        if not all(counts.values()) or not user_count:
+            raise SystemExit(f'{args.database} has no catalogue or users, run generate_dataset.py first')
+        queries = QueryCounter(db.engine)
+
+    scenario = Scenario(rng, counts, user_count, args.skew)
+    routes = scenario.routes()
+    if args.routes:
+        routes = {name: build for name, build in routes.items() if name in args.routes.split(',')}
+
+    client = app.test_client()
+    client.post('/login', data={'username': 'user000001', 'password': 'password'})
+
+    results = {}
+    for name, build in routes.items():
+        latencies, query_counts, errors, peak_bytes = [], [], 0, 0
+        for number in range(args.warmup + args.requests):
+            method, url, data = build()
+            if args.trace_memory:
+                tracemalloc.start()
+            queries.count = 0
+            started = time.perf_counter()
+            response = client.open(url, method=method, data=data)
+            elapsed = time.perf_counter() - started
+            if args.trace_memory:
+                peak_bytes = max(peak_bytes, tracemalloc.get_traced_memory()[1])
+                tracemalloc.stop()
+            scenario.record(name, response)
+            if response.status_code >= 400:
+                errors += 1
+            if number >= args.warmup:
+                latencies.append(elapsed * 1000)
+                query_counts.append(queries.count)
+
+        results[name] = {
+            'requests': len(latencies),
+            'errors': errors,
+            'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3),
+            'p99_ms': round(percentile(latencies, 0.99), 3),
+            'mean_ms': round(statistics.mean(latencies), 3),
+            'max_ms': round(max(latencies), 3),
+            'queries_mean': round(statistics.mean(query_counts), 2),
+            'queries_max': max(query_counts),
+        }
+        if args.trace_memory:
+            results[name]['peak_alloc_bytes'] = peak_bytes
+        print(f'{name:>10}  p50 {results[name]["p50_ms"]:8.2f}ms  p95 {results[name]["p95_ms"]:8.2f}ms  '
+              f'p99 {results[name]["p99_ms"]:8.2f}ms  queries {results[name]["queries_mean"]:5.1f}  errors {errors}')
+    return results
+
+
+def measure_page(client, scenario, route, seconds):
+    build = scenario.routes()[route]
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        method, url, data = build()
+        started = time.perf_counter()
+        client.open(url, method=method, data=data)
+        latencies.append((time.perf_counter() - started) * 1000)
+    return {'requests': len(latencies), 'p50_ms': round(percentile(latencies, 0.50), 3),
+            'p95_ms': round(percentile(latencies, 0.95), 3), 'p99_ms': round(percentile(latencies, 0.99), 3)}
+
+
+def login_load(args):
+    # The page alone, then the page while --login-threads threads keep logging in generated users
+    rng = random.Random(args.seed)
+    with app.app_context():
+        counts = {item_type: db.session.query(func.max(model.id)).scalar() or 0
+                  for item_type, model in CATALOGUE_MODELS.items()}
+        user_count = db.session.query(func.max(User.id)).scalar() or 0
+    scenario = Scenario(rng, counts, user_count, args.skew)
+    client = app.test_client()
+    alone = measure_page(client, scenario, args.login_page, args.login_seconds)
+
+    outcomes = {'logged_in': 0, 'refused': 0, 'failed': 0}
+    lock, stop = threading.Lock(), threading.Event()
+
+    def log_in():
+        login_client = app.test_client()
+        while not stop.is_set():
+            username = f'user{rng.randint(1, user_count):06d}'
+            response = login_client.post('/login', data={'username': username, 'password': 'password'})
+            outcome = 'logged_in' if response.status_code == 302 else 'refused' if response.status_code in (429, 503) else 'failed'
+            with lock:
+                outcomes[outcome] += 1
+
+    threads = [threading.Thread(target=log_in, daemon=True) for _ in range(args.login_threads)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    loaded = measure_page(client, scenario, args.login_page, args.login_seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    result = {'page': args.login_page, 'threads': args.login_threads, 'hash_workers': password_hasher.workers,
+              'page_alone': alone, 'page_under_load': loaded,
+              'logins_per_second': round(outcomes['logged_in'] / elapsed, 2), **outcomes}
+    print(f'{args.login_page} alone        p50 {alone["p50_ms"]:8.2f}ms  p95 {alone["p95_ms"]:8.2f}ms')
+    print(f'{args.login_page} under logins p50 {loaded["p50_ms"]:8.2f}ms  p95 {loaded["p95_ms"]:8.2f}ms  '
+          f'{result["logins_per_second"]} logins/s, {outcomes["refused"]} refused, {outcomes["failed"]} failed')
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark every route through the Flask test client.')
+    parser.add_argument('--database', default='sqlite:///benchmark.db')
+    parser.add_argument('--requests', type=int, default=200, help='measured requests per route')
+    parser.add_argument('--warmup', type=int, default=20, help='unmeasured requests per route first')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--skew', type=float, default=3.0, help='the --skew the database was generated with')
+    parser.add_argument('--routes', help='comma separated subset, e.g. book,profile')
+    parser.add_argument('--no-fragment-cache', action='store_true', help='render every fragment')
+    parser.add_argument('--trace-memory', action='store_true', help='peak Python allocations per route (slower)')
+    parser.add_argument('--output', help='write the results to this JSON file')
+    parser.add_argument('--login-load', action='store_true', help='measure a page while other threads keep logging in')
+    parser.add_argument('--login-threads', type=int, default=8)
+    parser.add_argument('--login-seconds', type=float, default=10, help='measuring time, alone and under load each')
+    parser.add_argument('--login-page', default='book', help='route measured during --login-load')
+    parser.add_argument('--hash-workers', type=int, help='override PASSWORD_HASH_WORKERS, 0 hashes inline')
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(args.database)
+    app.config['WTF_CSRF_ENABLED'] = False
+    if args.no_fragment_cache:
+        fragment_cache.backend = None
+    if args.hash_workers is not None:
+        password_hasher.workers = args.hash_workers
+
+    started = datetime.utcnow()
+    report = {
+        'database': args.database,
+        'started': started.isoformat(timespec='seconds'),
+        'seed': args.seed,
+        'fragment_cache': not args.no_fragment_cache,
+    }
+    if args.login_load:
+        report['login_load'] = login_load(args)
+    else:
+        report['requests_per_route'] = args.requests
+        report['routes'] = run(args)
+    if resource is not None:
+        # kilobytes on Linux
+        report['peak_rss_bytes'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        print(f'Peak RSS {report["peak_rss_bytes"] / 2 ** 20:.1f} MiB')
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
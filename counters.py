@@ -0,0 +1,28 @@
+from sqlalchemy import text
+
+# Books, movies and games carry review_count and last_reviewed_at so listings can be sorted by them
+# with an index instead of counting reviews. add_review / delete_review keep them up to date in the
+# same transaction as the review; reconcile_review_counters recomputes them from the review tables
+# for rows written by older code, imports or manual fixes.
+
+# item table -> (review table, foreign key)
+COUNTED_TABLES = {
+    'book': ('book_review', 'book_id'),
+    'movie': ('movie_review', 'movie_id'),
+    'game': ('game_review', 'game_id'),
+}
+
+
+def reconcile_review_counters(conn):
+    # One set based UPDATE per table touching only the rows that are off, returns {table: rows fixed}
+    differs = 'IS NOT' if conn.dialect.name == 'sqlite' else 'IS DISTINCT FROM'
+    fixed = {}
+    for table, (review_table, item_fk) in COUNTED_TABLES.items():
+        reviews = f'FROM {review_table} WHERE {review_table}.{item_fk} = {table}.id'
+        count, latest = f'(SELECT count(*) {reviews})', f'(SELECT max({review_table}.created_at) {reviews})'
+        result = conn.execute(text(
+            f'UPDATE {table} SET review_count = {count}, last_reviewed_at = {latest} '
+            f'WHERE review_count != {count} OR last_reviewed_at {differs} {latest}'
+        ))
+        fixed[table] = result.rowcount
+    return fixed
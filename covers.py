@@ -0,0 +1,151 @@
+import logging
+import os
+import queue
+import random
+import tempfile
+import threading
+import time
+from urllib.parse import urljoin, urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# Cover images from Open Library / OMDb are fetched by a few background threads instead of inside
+# the request that looked them up. Jobs wait in a bounded queue, each download streams into a temp
+# file next to its destination and is renamed into place only once complete, and failed attempts
+# are retried with exponential backoff. Items show the default cover until their job calls on_done.
+#
+# Only https URLs on the cover hosts (or their subdomains) are ever requested, redirects included, so a
+# URL that didn't come from Open Library / OMDb can't make the server fetch anything else.
+
+COVER_HOSTS = ('covers.openlibrary.org', 'archive.org', 'media-amazon.com', 'media-imdb.com')
+MAX_REDIRECTS = 5
+
+
+class CoverDownloadError(Exception):
+    pass
+
+
+def allowed_url(url, hosts=COVER_HOSTS):
+    parts = urlsplit(url)
+    try:
+        port = parts.port
+    except ValueError:
+        return False
+    host = (parts.hostname or '').lower()
+    return (parts.scheme == 'https' and port in (None, 443)
+            and any(host == allowed or host.endswith('.' + allowed) for allowed in hosts))
+
+
+class CoverDownloader:
+    def __init__(self, directory, workers=2, queue_size=100, retries=3, backoff=0.5,
+                 timeout=(3.05, 15), max_bytes=10 * 1024 * 1024, chunk_size=64 * 1024, hosts=COVER_HOSTS):
+        self.directory = directory
+        self.hosts = hosts
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._jobs = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._local = threading.local()
+
+    def submit(self, url, filename, on_done=None):
+        # Queue a download of `url` to directory/filename. on_done(filename) runs on the worker thread
+        # after the file is in place. Returns False when the queue is full and the job was dropped.
+        self._start()
+        try:
+            self._jobs.put_nowait((url, filename, on_done))
+        except queue.Full:
+            logger.warning('Cover queue full, dropped %s', url)
+            return False
+        return True
+
+    def join(self):
+        # block until every queued job has finished, for scripts and tests
+        self._jobs.join()
+
+    def _start(self):
+        # threads are started on first use so importing the app (e.g. for CLI commands) spawns nothing
+        with self._start_lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._work, name=f'cover-downloader-{len(self._threads)}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        while True:
+            url, filename, on_done = self._jobs.get()
+            try:
+                self.download(url, filename)
+                if on_done is not None:
+                    on_done(filename)
+            except Exception:
+                logger.exception('Cover download failed for %s', url)
+            finally:
+                self._jobs.task_done()
+
+    def _session(self):
+        # one pooled session per worker thread
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = requests.Session()
+            session.mount('http://', HTTPAdapter(pool_maxsize=1))
+            session.mount('https://', HTTPAdapter(pool_maxsize=1))
+        return session
+
+    def download(self, url, filename):
+        attempt = 0
+        while True:
+            try:
+                return self._fetch(url, os.path.join(self.directory, filename))
+            except (requests.ConnectionError, requests.Timeout, CoverDownloadError) as error:
+                retryable = not isinstance(error, CoverDownloadError) or getattr(error, 'retryable', False)
+                attempt += 1
+                if not retryable or attempt > self.retries:
+                    raise
+                # exponential backoff with jitter so several failing jobs don't retry in lockstep
+                time.sleep(self.backoff * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+    def _get(self, url):
+        # follows redirects by hand so every hop is checked against the allowed hosts
+        for _ in range(MAX_REDIRECTS + 1):
+            if not allowed_url(url, self.hosts):
+                raise CoverDownloadError(f'{url} is not an allowed cover URL')
+            response = self._session().get(url, stream=True, timeout=self.timeout, allow_redirects=False)
+            if not response.is_redirect:
+                return response
+            response.close()
+            url = urljoin(url, response.headers['Location'])
+        raise CoverDownloadError(f'{url} redirected too often')
+
+    def _fetch(self, url, path):
+        with self._get(url) as response:
+            if response.status_code != 200:
+                error = CoverDownloadError(f'{url} answered {response.status_code}')
+                error.retryable = response.status_code >= 500 or response.status_code == 429
+                raise error
+            content_type = response.headers.get('Content-Type', 'image/')
+            if not content_type.startswith('image/'):
+                raise CoverDownloadError(f'{url} is not an image ({content_type})')
+
+            handle, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.part')
+            try:
+                written = 0
+                with os.fdopen(handle, 'wb') as temp_file:
+                    for chunk in response.iter_content(self.chunk_size):
+                        written += len(chunk)
+                        if written > self.max_bytes:
+                            raise CoverDownloadError(f'{url} is larger than {self.max_bytes} bytes')
+                        temp_file.write(chunk)
+                # readers only ever see no file or the complete file
+                os.replace(temp_path, path)
+            except BaseException:
+                os.unlink(temp_path)
+                raise
+        return path
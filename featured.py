@@ -0,0 +1,89 @@
+import bisect
+import random
+import threading
+import time
+from array import array
+from types import SimpleNamespace
+
+
+def snapshot(item):
+    # plain copy of a row's columns, safe to keep around after the request's session is gone
+    return SimpleNamespace(**{column.key: getattr(item, column.key) for column in item.__table__.columns})
+
+
+class FeaturedSampler:
+    # Keeps the ids of every catalogue item in a compact sorted array per model so the index page
+    # can pick random items without ORDER BY RANDOM() scanning and sorting the table. Ids are found
+    # in the array by binary search, so nothing per item is kept beyond its 8 bytes.
+    # ttl: seconds a drawn batch of featured items is reused for (0 draws on every call)
+    # reload_interval: seconds before the id arrays are re-read, to pick up writes made by other workers
+
+    def __init__(self, ttl=0, reload_interval=300):
+        self.ttl = ttl
+        self.reload_interval = reload_interval
+        self._ids = {}
+        self._loaded_at = {}
+        self._batch = None
+        self._batch_at = 0
+        self._lock = threading.Lock()
+
+    def _ensure_loaded(self, model):
+        loaded_at = self._loaded_at.get(model)
+        if loaded_at is not None and time.monotonic() - loaded_at < self.reload_interval:
+            return
+        # only the primary key index is read here, never the rows themselves
+        ids = array('q', (item_id for (item_id,) in model.query.with_entities(model.id).order_by(model.id)))
+        self._ids[model] = ids
+        self._loaded_at[model] = time.monotonic()
+
+    def _find(self, model, item_id):
+        # (array, index where item_id is or belongs), the array is None when the model isn't loaded
+        ids = self._ids.get(model)
+        if ids is None:
+            return None, None
+        return ids, bisect.bisect_left(ids, item_id)
+
+    def add(self, model, item_id):
+        with self._lock:
+            ids, index = self._find(model, item_id)
+            if ids is None or (index < len(ids) and ids[index] == item_id):
+                return
+            # new ids are the largest, so this is almost always an append
+            ids.insert(index, item_id)
+
+    def remove(self, model, item_id):
+        with self._lock:
+            self._batch = None
+            ids, index = self._find(model, item_id)
+            if ids is None or index == len(ids) or ids[index] != item_id:
+                return
+            del ids[index]
+
+    def sample(self, model, k):
+        with self._lock:
+            self._ensure_loaded(model)
+            ids = self._ids[model]
+            return [ids[index] for index in random.sample(range(len(ids)), min(k, len(ids)))]
+
+    def featured(self, models, k):
+        # returns {model: [item, ...]} for all carousels at once, cached for `ttl` seconds
+        batch = self._batch
+        if batch is not None and time.monotonic() - self._batch_at < self.ttl:
+            return batch
+
+        batch = {}
+        for model in models:
+            ids = self.sample(model, k)
+            rows = {item.id: item for item in model.query.filter(model.id.in_(ids))} if ids else {}
+            batch[model] = [snapshot(rows[item_id]) for item_id in ids if item_id in rows]
+
+        with self._lock:
+            self._batch = batch
+            self._batch_at = time.monotonic()
+        return batch
+
+    def reset(self):
+        with self._lock:
+            self._ids.clear()
+            self._loaded_at.clear()
+            self._batch = None
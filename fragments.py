@@ -0,0 +1,174 @@
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from metadata_client import MISSING
+
+# Rendered HTML fragments (item headers and review lists on the detail pages) kept between requests.
+# Keys contain the item's version counter, which every write to the item or its reviews increments,
+# so a stale fragment is simply never asked for again and ages out of the cache.
+# The memory backend is per process; the SQLite backend is shared by all workers on a host.
+
+
+class MemoryBackend:
+    # least recently used entries are dropped past max_entries, ttl is ignored since versions do the invalidation
+
+    def __init__(self, max_entries=1000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            value = self._entries.get(key, MISSING)
+            if value is not MISSING:
+                self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def forget(self, prefixes):
+        with self._lock:
+            for key in [key for key in self._entries if key.startswith(prefixes)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteBackend:
+    # Fragments on disk, shared by the workers of a host and trimmed least recently used first past max_bytes.
+    # A hit is read only: the time it was used is remembered in memory and written with the next set (or
+    # once touch_batch keys are waiting), which is when eviction needs it. The total size is kept in a one
+    # row table by triggers so a write never has to add up the whole cache.
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS fragment_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, '
+        'size INTEGER NOT NULL, expires_at REAL NOT NULL, used_at REAL NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS ix_fragment_cache_expires_at ON fragment_cache (expires_at)',
+        'CREATE INDEX IF NOT EXISTS ix_fragment_cache_used_at ON fragment_cache (used_at)',
+        'CREATE TABLE IF NOT EXISTS fragment_cache_size (id INTEGER PRIMARY KEY CHECK (id = 0), total INTEGER NOT NULL)',
+        'INSERT OR IGNORE INTO fragment_cache_size (id, total) SELECT 0, COALESCE(SUM(size), 0) FROM fragment_cache',
+        'CREATE TRIGGER IF NOT EXISTS fragment_cache_added AFTER INSERT ON fragment_cache BEGIN '
+        'UPDATE fragment_cache_size SET total = total + new.size WHERE id = 0; END',
+        'CREATE TRIGGER IF NOT EXISTS fragment_cache_removed AFTER DELETE ON fragment_cache BEGIN '
+        'UPDATE fragment_cache_size SET total = total - old.size WHERE id = 0; END',
+        'CREATE TRIGGER IF NOT EXISTS fragment_cache_replaced AFTER UPDATE OF size ON fragment_cache BEGIN '
+        'UPDATE fragment_cache_size SET total = total - old.size + new.size WHERE id = 0; END',
+    )
+
+    def __init__(self, path, max_bytes=100 * 1024 * 1024, touch_batch=1000):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.touch_batch = touch_batch
+        self._touched = {}  # key -> time of its last hit, not yet written
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        conn = sqlite3.connect(path, timeout=5)
+        try:
+            conn.execute('PRAGMA journal_mode=WAL')  # readers never wait for a writer
+            with conn:
+                for statement in self.SCHEMA:
+                    conn.execute(statement)
+        finally:
+            conn.close()
+
+    def _connection(self):
+        # one connection per thread, opened on first use so none is carried across a fork
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+        return conn
+
+    def get(self, key):
+        now = time.time()
+        row = self._connection().execute('SELECT value, expires_at FROM fragment_cache WHERE key = ?', (key,)).fetchone()
+        if row is None or row[1] < now:
+            return MISSING  # an expired entry is replaced by the set that follows the miss
+        with self._lock:
+            self._touched[key] = now
+            flush = len(self._touched) >= self.touch_batch
+        if flush:
+            with self._connection() as conn:
+                self._flush_touched(conn)
+        return row[0]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._connection() as conn:
+            conn.execute('INSERT INTO fragment_cache (key, value, size, expires_at, used_at) VALUES (?, ?, ?, ?, ?) '
+                         'ON CONFLICT (key) DO UPDATE SET value = excluded.value, size = excluded.size, '
+                         'expires_at = excluded.expires_at, used_at = excluded.used_at',
+                         (key, value, len(value), now + ttl, now))
+            self._flush_touched(conn)
+            self._evict(conn, now)
+
+    def _flush_touched(self, conn):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            conn.executemany('UPDATE fragment_cache SET used_at = ? WHERE key = ? AND used_at < ?',
+                             [(used_at, key, used_at) for key, used_at in touched.items()])
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM fragment_cache WHERE expires_at < ?', (now,))
+        total = conn.execute('SELECT total FROM fragment_cache_size WHERE id = 0').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used entries until we are back under 90% of the limit
+        excess = total - self.max_bytes * 0.9
+        for key, size in conn.execute('SELECT key, size FROM fragment_cache ORDER BY used_at').fetchall():
+            if excess <= 0:
+                break
+            conn.execute('DELETE FROM fragment_cache WHERE key = ?', (key,))
+            excess -= size
+
+    def forget(self, prefixes):
+        # every key starting with one of the prefixes, each a range of the primary key
+        with self._connection() as conn:
+            conn.executemany('DELETE FROM fragment_cache WHERE key >= ? AND key < ?',
+                             [(prefix, prefix + '\U0010ffff') for prefix in prefixes])
+
+    def clear(self):
+        with self._lock:
+            self._touched.clear()
+        with self._connection() as conn:
+            conn.execute('DELETE FROM fragment_cache')
+
+
+class FragmentCache:
+    def __init__(self, backend=None, ttl=24 * 3600):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_render(self, key_parts, render):
+        # `render` is only called on a miss; with no backend configured every call renders
+        if self.backend is None:
+            return render()
+        key = '|'.join(str(part) for part in key_parts)
+        fragment = self.backend.get(key)
+        if fragment is not MISSING:
+            self.hits += 1
+            return fragment
+        self.misses += 1
+        fragment = str(render())
+        self.backend.set(key, fragment, self.ttl)
+        return fragment
+
+    def forget(self, key_prefixes):
+        # Drops the fragments whose key starts with any of the given parts, e.g. [('book', 2)] for a deleted book
+        if self.backend is not None and key_prefixes:
+            self.backend.forget(tuple('|'.join(str(part) for part in parts) + '|' for parts in key_prefixes))
@@ -0,0 +1,163 @@
+import argparse
+import math
+import random
+import time
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from werkzeug.security import generate_password_hash
+
+from counters import reconcile_review_counters
+from database import engine_options
+from genres import backfill_genres
+from app import CATALOGUE_MODELS, REVIEW_SOURCES, User, app, db
+from migrations import upgrade
+
+# Fill a fresh database with a synthetic catalogue at realistic volume, for benchmark.py and profiling.
+#
+#   python generate_dataset.py --database sqlite:///benchmark.db
+#
+# The defaults are 100k books, movies and games each, 50k users and 2M reviews. Popularity is skewed
+# the way real review sites are: a small share of the items gets most of the reviews, and a small share
+# of the users writes most of them. The same --seed always produces the same rows.
+# Every user's password is "password".
+
+WORDS = ('star', 'void', 'echo', 'ember', 'drift', 'signal', 'orbit', 'tide', 'machine', 'garden', 'ash', 'crown',
+         'silence', 'mirror', 'harbor', 'storm', 'glass', 'iron', 'ghost', 'winter', 'nebula', 'archive', 'lantern',
+         'horizon', 'circuit', 'veil', 'relic', 'pilgrim', 'citadel', 'fracture', 'spire', 'salt', 'cinder', 'atlas')
+NAMES = ('Ada', 'Ursula', 'Isaac', 'Octavia', 'Arthur', 'Philip', 'Nnedi', 'Liu', 'Iain', 'Becky', 'Ted', 'Martha',
+         'Stanislaw', 'Gene', 'Hayao', 'Denis', 'Ridley', 'Hideo', 'Kojima', 'Lana', 'Rian', 'Ann', 'Jeff', 'Kim')
+SURNAMES = ('Leckie', 'Le Guin', 'Asimov', 'Butler', 'Clarke', 'Dick', 'Okorafor', 'Cixin', 'Banks', 'Chambers',
+            'Chiang', 'Wells', 'Lem', 'Wolfe', 'Miyazaki', 'Villeneuve', 'Scott', 'Vandermeer', 'Stanley', 'Robinson')
+STUDIOS = ('Nebula Works', 'Farside Games', 'Quiet Orbit', 'Red Giant Interactive', 'Lantern Forge', 'Drift Studio',
+           'Iron Tide', 'Glass Citadel', 'Salt & Cinder', 'Atlas Nine')
+GENRES = ('Science Fiction', 'Fantasy', 'Horror', 'Dystopian', 'Space Opera', 'Cyberpunk', 'Post-Apocalyptic',
+          'Alternate History', 'Weird Fiction', 'Solarpunk', 'Time Travel', 'First Contact')
+
+# share of the reviews going to each item type
+REVIEW_SHARE = {'book': 0.5, 'movie': 0.3, 'game': 0.2}
+
+
+def skewed_id(rng, count, skew):
+    # Popularity rank drawn from a power law (rank 0 is the most popular), spread over the id space with a
+    # fixed stride so the popular items are not simply the oldest ones
+    rank = min(int(count * rng.random() ** skew), count - 1)
+    return rank * _stride(count) % count + 1
+
+
+@lru_cache()
+def _stride(count):
+    stride = 7919
+    while math.gcd(stride, count) != 1:
+        stride += 2
+    return stride
+
+
+def sentence(rng, words):
+    return ' '.join(rng.choice(WORDS) for _ in range(words)).capitalize() + '.'
+
+
+def title(rng):
+    return ' '.join(word.capitalize() for word in rng.sample(WORDS, rng.randint(1, 4)))
+
+
+def person(rng):
+    return f'{rng.choice(NAMES)} {rng.choice(SURNAMES)}'
+
+
+def catalogue_rows(rng, item_type, count):
+    creator_field = {'book': 'author', 'movie': 'director', 'game': 'studio'}[item_type]
+    for _ in range(count):
+        yield {
+            'title': title(rng),
+            creator_field: rng.choice(STUDIOS) if item_type == 'game' else person(rng),
+            'genre': ', '.join(rng.sample(GENRES, rng.randint(1, 3))),
+            'synopsis': ' '.join(sentence(rng, rng.randint(6, 14)) for _ in range(rng.randint(2, 5))),
+            'cover_image': 'default_cover.png',
+            'version': 1,
+        }
+
+
+def user_rows(rng, count, password_hash):
+    for number in range(1, count + 1):
+        yield {'username': f'user{number:06d}', 'password': password_hash,
+               'bio': sentence(rng, rng.randint(4, 12)) if rng.random() < 0.4 else None,
+               'avatar': 'default_avatar.png'}
+
+
+def review_rows(rng, count, item_type, item_count, user_count, skew, start, span):
+    # created_at grows with the id, like reviews written over `span` seconds
+    for number in range(count):
+        yield {
+            'content': ' '.join(sentence(rng, rng.randint(5, 15)) for _ in range(rng.randint(1, 4))),
+            'user_id': skewed_id(rng, user_count, skew / 2 + 0.5),
+            f'{item_type}_id': skewed_id(rng, item_count, skew),
+            'created_at': start + timedelta(seconds=span * number / count + rng.random()),
+        }
+
+
+def insert(table, rows, batch_size, label):
+    started = time.perf_counter()
+    inserted = 0
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) == batch_size:
+            db.session.execute(table.insert(), batch)
+            db.session.commit()
+            inserted += len(batch)
+            batch = []
+    if batch:
+        db.session.execute(table.insert(), batch)
+        db.session.commit()
+        inserted += len(batch)
+    print(f'{label}: {inserted} rows in {time.perf_counter() - started:.1f}s')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate a synthetic catalogue, users and reviews.')
+    parser.add_argument('--database', default='sqlite:///benchmark.db', help='SQLAlchemy URI of an empty database')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--books', type=int, default=100_000)
+    parser.add_argument('--movies', type=int, default=100_000)
+    parser.add_argument('--games', type=int, default=100_000)
+    parser.add_argument('--users', type=int, default=50_000)
+    parser.add_argument('--reviews', type=int, default=2_000_000)
+    parser.add_argument('--skew', type=float, default=3.0, help='higher puts more reviews on fewer items, 1 is uniform')
+    parser.add_argument('--days', type=int, default=5 * 365, help='period the reviews were written over')
+    parser.add_argument('--batch-size', type=int, default=10_000)
+    args = parser.parse_args()
+
+    app.config['SQLALCHEMY_DATABASE_URI'] = args.database
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(args.database)
+    rng = random.Random(args.seed)
+    counts = {'book': args.books, 'movie': args.movies, 'game': args.games}
+
+    with app.app_context():
+        db.create_all()
+        upgrade(db.engine)
+        if User.query.first() is not None or any(model.query.first() for model in CATALOGUE_MODELS.values()):
+            raise SystemExit(f'{args.database} already has data, generate into an empty database')
+
+        for item_type, model in CATALOGUE_MODELS.items():
+            insert(model.__table__, catalogue_rows(rng, item_type, counts[item_type]), args.batch_size, item_type)
+        # one hash for everyone, hashing 50k passwords would take longer than the rest of the run
+        password_hash = generate_password_hash('password', app.config['PASSWORD_HASH_METHOD'], app.config['PASSWORD_SALT_LENGTH'])
+        insert(User.__table__, user_rows(rng, args.users, password_hash), args.batch_size, 'user')
+
+        span = args.days * 24 * 3600
+        start = datetime.utcnow() - timedelta(seconds=span)
+        for item_type, review_model, _, _ in REVIEW_SOURCES:
+            count = int(args.reviews * REVIEW_SHARE[item_type])
+            if counts[item_type] and args.users:
+                rows = review_rows(rng, count, item_type, counts[item_type], args.users, args.skew, start, span)
+                insert(review_model.__table__, rows, args.batch_size, f'{item_type} review')
+
+        # the rows went in past the ORM, so fill what the app would have kept up to date alongside them
+        reconcile_review_counters(db.session.connection())
+        backfill_genres(db.session.connection())
+        db.session.commit()
+
+
+if __name__ == '__main__':
+    main()
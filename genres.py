@@ -0,0 +1,118 @@
+import re
+from collections import Counter
+
+from sqlalchemy import bindparam, text
+
+# Genres are typed in (or come from Open Library / OMDb) as one comma separated string per item. Each name
+# is also kept once in the genre table, keyed by a slug so "Sci-Fi" and "sci fi" are the same genre, and
+# linked to its items through book_genre / movie_genre / game_genre, whose (genre_id, item id) primary key
+# lets a genre's listing be read in id order straight from the index.
+#
+# genre_count holds how many items of each type carry each genre, for the facet lists next to the
+# listings. link_genres / unlink_genres adjust it in the same transaction as the items they are called
+# for, reconcile_genre_counts recounts it from the links.
+
+# item type -> (link table, item foreign key)
+GENRE_LINKS = {
+    'book': ('book_genre', 'book_id'),
+    'movie': ('movie_genre', 'movie_id'),
+    'game': ('game_genre', 'game_id'),
+}
+MAX_NAME_LENGTH = 100
+ID_BATCH = 500
+
+
+def genre_slug(name):
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')[:MAX_NAME_LENGTH]
+
+
+def parse_genres(value):
+    # "Fantasy, Science Fiction,  fantasy" -> ['Fantasy', 'Science Fiction'], first spelling wins
+    names = {}
+    for name in (value or '').split(','):
+        name = ' '.join(name.split())[:MAX_NAME_LENGTH]
+        if genre_slug(name):
+            names.setdefault(genre_slug(name), name)
+    return list(names.values())
+
+
+def _batches(values):
+    values = list(values)
+    for start in range(0, len(values), ID_BATCH):
+        yield values[start:start + ID_BATCH]
+
+
+def genre_ids(conn, names):
+    # {slug: genre id} for the given names, adding the genres not seen before
+    wanted = {}
+    for name in names:
+        wanted.setdefault(genre_slug(name), name)
+    select_ids = text('SELECT slug, id FROM genre WHERE slug IN :slugs').bindparams(bindparam('slugs', expanding=True))
+    ids = {}
+    for batch in _batches(wanted):
+        ids.update(conn.execute(select_ids, {'slugs': batch}).fetchall())
+    missing = [{'name': name, 'slug': slug} for slug, name in wanted.items() if slug not in ids]
+    if missing:
+        # another request may add the same genre at the same time, its row is as good as ours
+        conn.execute(text('INSERT INTO genre (name, slug) VALUES (:name, :slug) ON CONFLICT (slug) DO NOTHING'), missing)
+        for batch in _batches(row['slug'] for row in missing):
+            ids.update(conn.execute(select_ids, {'slugs': batch}).fetchall())
+    return ids
+
+
+def _adjust_counts(conn, item_type, deltas):
+    rows = [{'item_type': item_type, 'genre_id': genre_id, 'delta': delta} for genre_id, delta in deltas.items() if delta]
+    if rows:
+        conn.execute(text('INSERT INTO genre_count (item_type, genre_id, item_count) VALUES (:item_type, :genre_id, :delta) '
+                          'ON CONFLICT (item_type, genre_id) DO UPDATE SET item_count = genre_count.item_count + :delta'),
+                     rows)
+
+
+def link_genres(conn, item_type, items):
+    # Links new items, given as (id, genre string) pairs, to their genres and counts them in; returns the links made
+    link_table, item_fk = GENRE_LINKS[item_type]
+    parsed = [(item_id, parse_genres(genre)) for item_id, genre in items]
+    ids = genre_ids(conn, [name for _, names in parsed for name in names])
+    links = [{'genre_id': ids[genre_slug(name)], 'item_id': item_id} for item_id, names in parsed for name in names]
+    if links:
+        conn.execute(text(f'INSERT INTO {link_table} (genre_id, {item_fk}) VALUES (:genre_id, :item_id)'), links)
+        _adjust_counts(conn, item_type, Counter(link['genre_id'] for link in links))
+    return len(links)
+
+
+def unlink_genres(conn, item_type, item_ids):
+    # Removes the links of items about to be deleted and counts them out
+    link_table, item_fk = GENRE_LINKS[item_type]
+    deltas = Counter()
+    for batch in _batches(item_ids):
+        for genre_id, count in conn.execute(
+                text(f'SELECT genre_id, count(*) FROM {link_table} WHERE {item_fk} IN :ids GROUP BY genre_id')
+                .bindparams(bindparam('ids', expanding=True)), {'ids': batch}):
+            deltas[genre_id] -= count
+        conn.execute(text(f'DELETE FROM {link_table} WHERE {item_fk} IN :ids').bindparams(bindparam('ids', expanding=True)),
+                     {'ids': batch})
+    _adjust_counts(conn, item_type, deltas)
+
+
+def reconcile_genre_counts(conn):
+    # Recounts every genre from the links, returns {item type: genres with items}
+    conn.execute(text('DELETE FROM genre_count'))
+    counted = {}
+    for item_type, (link_table, _) in GENRE_LINKS.items():
+        counted[item_type] = conn.execute(text(
+            f'INSERT INTO genre_count (item_type, genre_id, item_count) '
+            f'SELECT :item_type, genre_id, count(*) FROM {link_table} GROUP BY genre_id'), {'item_type': item_type}).rowcount
+    return counted
+
+
+def backfill_genres(conn, batch_size=1000):
+    # Links every item that has no genre links yet from its genre string, returns {item type: links made}
+    linked = {}
+    for item_type, (link_table, item_fk) in GENRE_LINKS.items():
+        rows = conn.execute(text(
+            f'SELECT id, genre FROM {item_type} WHERE NOT EXISTS '
+            f'(SELECT 1 FROM {link_table} WHERE {link_table}.{item_fk} = {item_type}.id) ORDER BY id')).fetchall()
+        linked[item_type] = sum(link_genres(conn, item_type, rows[start:start + batch_size])
+                                for start in range(0, len(rows), batch_size))
+    reconcile_genre_counts(conn)
+    return linked
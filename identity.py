@@ -0,0 +1,52 @@
+import threading
+import time
+from collections import OrderedDict
+
+# The logged in user is needed on nearly every request, but changes only when they edit their profile.
+# Their column values are kept here for `ttl` seconds (least recently used users dropped past
+# `max_entries`) under (user id, stamp), where the stamp lives in the user's own session cookie.
+# Editing the profile writes a new stamp into the session, so every worker process misses on its next
+# request from that user and reloads, without workers having to tell each other anything.
+
+
+class IdentityCache:
+    def __init__(self, ttl=60, max_entries=10000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id, stamp):
+        # the cached column values, or None
+        if not self.ttl:
+            return None
+        key = (user_id, stamp)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, values = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return values
+
+    def set(self, user_id, stamp, values):
+        if not self.ttl:
+            return
+        with self._lock:
+            self._entries[(user_id, stamp)] = (time.monotonic() + self.ttl, values)
+            self._entries.move_to_end((user_id, stamp))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id):
+        # drop every stamp of one user held by this process
+        with self._lock:
+            for key in [key for key in self._entries if key[0] == user_id]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,205 @@
+import hashlib
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+from PIL import Image
+
+logger = logging.getLogger(__name__)
+
+# Covers and avatars are stored under the hash of their content instead of a name made up from
+# the title or the uploaded filename, so two items can never overwrite each other's image and a
+# URL always points at the same bytes (which lets browsers cache them forever). Next to the
+# full-size image every upload gets smaller variants for cards and detail pages, all in JPEG and WebP:
+#   <hash>.jpg  <hash>.webp  <hash>-card.jpg  <hash>-card.webp  <hash>-detail.jpg  <hash>-detail.webp
+
+COVER_SIZES = {'card': (240, 360), 'detail': (480, 720)}
+AVATAR_SIZES = {'card': (100, 100), 'detail': (200, 200)}
+
+FORMATS = (
+    ('jpg', 'JPEG', {'quality': 85, 'optimize': True, 'progressive': True}),
+    ('webp', 'WEBP', {'quality': 80, 'method': 4}),
+)
+
+# Uploads are checked against these from their header before being decoded
+ALLOWED_FORMATS = {'JPEG', 'PNG', 'WEBP', 'GIF'}
+DEFAULT_MAX_PIXELS = 40_000_000
+
+HASHED_NAME = re.compile(r'^([0-9a-f]{16})(?:-([a-z]+))?\.(jpg|webp)$')
+
+
+class ImageError(Exception):
+    # the file could not be decoded as an image
+    pass
+
+
+def hashed_image(filename):
+    # the content hash of a stored image, or None for legacy / default images that have no variants
+    match = HASHED_NAME.match(filename or '')
+    return match.group(1) if match and match.group(2) is None else None
+
+
+def variant_names(digest, sizes):
+    names = [f'{digest}.{extension}' for extension, _, _ in FORMATS]
+    for size in sizes:
+        names += [f'{digest}-{size}.{extension}' for extension, _, _ in FORMATS]
+    return names
+
+
+def _save(image, path, image_format, options):
+    # write next to the destination and rename, so a half written file is never served
+    handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.part')
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            image.save(temp_file, image_format, **options)
+        os.replace(temp_path, path)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+
+
+class ImageTooLarge(ImageError):
+    # more bytes or pixels than the configured limits
+    pass
+
+
+def _copy_hashed(stream, directory, max_bytes, chunk_size):
+    # Streams to a temp file next to the images, hashing on the way; returns (content hash, temp path)
+    handle, temp_path = tempfile.mkstemp(dir=directory, suffix='.part')
+    digest, size = hashlib.sha256(), 0
+    try:
+        with os.fdopen(handle, 'wb') as temp_file:
+            for chunk in iter(lambda: stream.read(chunk_size), b''):
+                size += len(chunk)
+                if max_bytes and size > max_bytes:
+                    raise ImageTooLarge(f'larger than {max_bytes} bytes')
+                digest.update(chunk)
+                temp_file.write(chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return digest.hexdigest()[:16], temp_path
+
+
+def _open_checked(path, max_pixels):
+    # Reads only the header first, so bogus files and huge dimensions are refused before anything is decoded
+    try:
+        image = Image.open(path)
+        if image.format not in ALLOWED_FORMATS:
+            raise ImageError(f'unsupported image format {image.format}')
+        width, height = image.size
+        if max_pixels and width * height > max_pixels:
+            raise ImageTooLarge(f'{width}x{height} is more than {max_pixels} pixels')
+        image.load()
+    except (OSError, ValueError, Image.DecompressionBombError) as error:
+        raise ImageError(str(error)) from error
+    return image
+
+
+def store_upload(stream, directory, sizes, max_bytes=None, max_pixels=DEFAULT_MAX_PIXELS, chunk_size=64 * 1024):
+    # Stores the image read from `stream` (an upload, a downloaded or an old file) and its variants in
+    # `directory`, returns the filename to keep in the database. The upload is never held in memory whole;
+    # one already stored under the same content hash is recognised without being decoded again.
+    digest, temp_path = _copy_hashed(stream, directory, max_bytes, chunk_size)
+    try:
+        filename = f'{digest}.jpg'
+        paths = [os.path.join(directory, name) for name in variant_names(digest, sizes)]
+        if all(os.path.exists(path) for path in paths):
+            try:
+                # the files may be orphans about to be swept, restart their grace period for the row about to use them
+                for path in paths:
+                    os.utime(path)
+                return filename
+            except FileNotFoundError:
+                pass  # swept just now, stored again below
+
+        with _open_checked(temp_path, max_pixels) as image:
+            if image.mode != 'RGB':
+                # flatten transparency onto white, JPEG has no alpha channel
+                background = Image.new('RGB', image.size, (255, 255, 255))
+                rgba = image.convert('RGBA')
+                background.paste(rgba, mask=rgba.getchannel('A'))
+                image = background
+
+            for extension, image_format, options in FORMATS:
+                _save(image, os.path.join(directory, f'{digest}.{extension}'), image_format, options)
+            for size, box in sizes.items():
+                variant = image.copy()
+                variant.thumbnail(box, Image.LANCZOS)
+                for extension, image_format, options in FORMATS:
+                    _save(variant, os.path.join(directory, f'{digest}-{size}.{extension}'), image_format, options)
+        return filename
+    finally:
+        os.unlink(temp_path)
+
+
+def add_missing_webp(directory, filename):
+    # Writes the full-size WebP next to a stored <hash>.jpg from before it was made, returns True if it was missing
+    path = os.path.join(directory, f'{hashed_image(filename)}.webp')
+    if os.path.exists(path):
+        return False
+    try:
+        with Image.open(os.path.join(directory, filename)) as image:
+            _save(image, path, 'WEBP', FORMATS[1][2])
+    except OSError as error:
+        raise ImageError(str(error)) from error
+    return True
+
+
+def is_content_addressed(filename):
+    # true for any stored image or variant name, e.g. "<hash>-card.webp"
+    return bool(HASHED_NAME.match(filename or ''))
+
+
+class ImageSweeper:
+    # Deletes stored images, with all their variants, that no row points at any more (deleted items,
+    # replaced covers and avatars), plus temp files left behind by interrupted writes. Runs on a
+    # background thread whenever request() is called; several requests while it is busy make one more run.
+    # `targets` is [(directory, referenced)] where referenced() returns the filenames still in use.
+    # Files younger than `grace` seconds are kept, their row may not be committed yet.
+
+    def __init__(self, targets, grace=3600):
+        self.targets = targets
+        self.grace = grace
+        self._wake = threading.Event()
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def request(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._work, name='image-sweeper', daemon=True)
+                self._thread.start()
+        self._wake.set()
+
+    def _work(self):
+        while True:
+            self._wake.wait()
+            self._wake.clear()
+            try:
+                self.sweep()
+            except Exception:
+                logger.exception('Image sweep failed')
+
+    def sweep(self):
+        # returns the number of files removed
+        removed = 0
+        cutoff = time.time() - self.grace
+        for directory, referenced in self.targets:
+            in_use = {hashed_image(name) for name in referenced()}
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    match = HASHED_NAME.match(entry.name)
+                    orphaned = match is not None and match.group(1) not in in_use
+                    if (orphaned or entry.name.endswith('.part')) and entry.stat().st_mtime < cutoff:
+                        try:
+                            os.unlink(entry.path)
+                            removed += 1
+                        except FileNotFoundError:
+                            pass
+        if removed:
+            logger.info('Removed %d unused image files', removed)
+        return removed
@@ -0,0 +1,195 @@
+import argparse
+import csv
+import itertools
+import json
+import os
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from app import CATALOGUE_MODELS, app, bump_collection, bump_version, cover_downloader, db, metadata_client, store_downloaded_cover
+from covers import CoverDownloadError
+from genres import link_genres
+from images import ImageError
+from metadata_client import MetadataError
+
+# Bulk load books, movies and games from a CSV or JSONL file.
+#
+#   python import_catalogue.py titles.csv --type book
+#
+# Every row is either a lookup ({"isbn": ...} for books, {"imdb": ...} for movies) or a full record
+# with title, creator (or author / director / studio), genre and optionally synopsis and cover_url.
+# A "type" column overrides --type per row. Lookups and cover downloads run on a bounded thread pool,
+# each batch of rows is inserted in one transaction, and the number of rows done is written to a
+# checkpoint file right after every batch is committed so an interrupted import picks up where it stopped.
+# JSONL lines that don't parse are reported as failed rows like any other.
+
+CREATOR_FIELDS = {'book': 'author', 'movie': 'director', 'game': 'studio'}
+
+
+def read_records(path):
+    with open(path, newline='', encoding='utf-8') as source:
+        if path.endswith('.jsonl') or path.endswith('.ndjson'):
+            for number, line in enumerate(source, 1):
+                if not line.strip():
+                    continue
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    record = None
+                # a broken line still counts as a row, resolve() turns it into that row's failure
+                yield record if isinstance(record, dict) else {'line': number, 'invalid_json': line.strip()[:200]}
+        else:
+            for row in csv.DictReader(source):
+                yield {key: value for key, value in row.items() if value not in (None, '')}
+
+
+def load_checkpoint(path, source):
+    if not os.path.exists(path):
+        return 0
+    with open(path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint.get('source') != source:
+        raise SystemExit(f'{path} belongs to an import of {checkpoint.get("source")}, use --restart to start over')
+    return checkpoint['processed']
+
+
+def save_checkpoint(path, source, processed):
+    # written to a temp file and renamed, so a crash never leaves a half written checkpoint
+    with open(path + '.tmp', 'w') as checkpoint_file:
+        json.dump({'source': source, 'processed': processed}, checkpoint_file)
+    os.replace(path + '.tmp', path)
+
+
+def resolve(record, default_type):
+    # Returns (item_type, fields, cover_url) for one input row, looking it up online when needed
+    if 'invalid_json' in record:
+        raise ValueError(f'line {record["line"]} is not a JSON object')
+    item_type = record.get('type', default_type)
+    if item_type not in CATALOGUE_MODELS:
+        raise ValueError(f'unknown type {item_type!r}')
+    creator_field = CREATOR_FIELDS[item_type]
+    creator = record.get('creator') or record.get(creator_field)
+
+    if record.get('title') and creator and record.get('genre'):
+        details = {'title': record['title'], creator_field: creator, 'genre': record['genre'],
+                   'synopsis': record.get('synopsis', ''), 'cover_url': record.get('cover_url')}
+    elif item_type == 'book' and record.get('isbn'):
+        details = metadata_client.lookup_isbn(str(record['isbn']))
+    elif item_type == 'movie' and record.get('imdb'):
+        details = metadata_client.lookup_imdb(str(record['imdb']))
+    else:
+        raise ValueError('row has neither a complete record nor an ISBN / IMDB id')
+
+    cover_url = details.pop('cover_url', None)
+    if not details.get('title') or not details.get(creator_field) or not details.get('genre'):
+        raise ValueError('title, creator and genre are required')
+    return item_type, details, cover_url
+
+
+def fetch_cover(model, item_id, cover_url):
+    filename = f'{model.__tablename__}_{item_id}_download.part'
+    cover_downloader.download(cover_url, filename)
+    return store_downloaded_cover(filename)
+
+
+def import_batch(pool, batch, default_type, with_covers, failures):
+    # Inserts a batch in one transaction, returns (items imported, [(model, item id, cover url)] to download)
+    resolved = []
+    for record, outcome in zip(batch, pool.map(lambda record: _attempt(resolve, record, default_type), batch)):
+        if isinstance(outcome, Exception):
+            failures.append((record, outcome))
+        else:
+            resolved.append(outcome)
+
+    items = []
+    for item_type, details, cover_url in resolved:
+        item = CATALOGUE_MODELS[item_type](**details)
+        db.session.add(item)
+        items.append((item, cover_url))
+    db.session.flush()
+    for item_type in CATALOGUE_MODELS:
+        link_genres(db.session.connection(), item_type,
+                    [(item.id, item.genre) for item, _ in items if item.__tablename__ == item_type])
+    bump_collection(*{item_type for item_type, _, _ in resolved})
+    db.session.commit()
+    return len(items), [(type(item), item.id, cover_url) for item, cover_url in items if cover_url and with_covers]
+
+
+def import_covers(pool, downloads, failures):
+    # Downloads the covers of a committed batch, returns how many were set. Runs after the checkpoint is
+    # saved, so an import stopped here keeps the default covers of the batch rather than importing it twice.
+    covers = list(pool.map(lambda job: _attempt(fetch_cover, *job), downloads))
+    updated = 0
+    for (model, item_id, cover_url), outcome in zip(downloads, covers):
+        if isinstance(outcome, Exception):
+            failures.append(({'cover_url': cover_url, 'id': item_id}, outcome))
+        else:
+            model.query.filter_by(id=item_id).update({'cover_image': outcome})
+            bump_version(model, item_id)
+            updated += 1
+    bump_collection(*{model.__tablename__ for model, _, _ in downloads})
+    db.session.commit()
+    return updated
+
+
+def _attempt(func, *args):
+    # failures are collected per row instead of aborting the whole import
+    try:
+        return func(*args)
+    except (MetadataError, CoverDownloadError, ImageError, ValueError, OSError) as error:
+        return error
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk import books, movies and games from CSV or JSONL.')
+    parser.add_argument('source', help='a .csv, .jsonl or .ndjson file')
+    parser.add_argument('--type', default='book', choices=sorted(CATALOGUE_MODELS), help='item type for rows without one')
+    parser.add_argument('--batch-size', type=int, default=200)
+    parser.add_argument('--workers', type=int, default=8, help='concurrent lookups / cover downloads')
+    parser.add_argument('--checkpoint', help='defaults to <source>.checkpoint')
+    parser.add_argument('--restart', action='store_true', help='ignore an existing checkpoint')
+    parser.add_argument('--no-covers', action='store_true', help='skip cover downloads')
+    parser.add_argument('--failures', help='write failed rows to this JSONL file')
+    args = parser.parse_args()
+
+    source = os.path.abspath(args.source)
+    checkpoint = args.checkpoint or source + '.checkpoint'
+    skip = 0 if args.restart else load_checkpoint(checkpoint, source)
+    if skip:
+        print(f'Resuming after {skip} rows')
+
+    processed, imported, covers, failures = skip, 0, 0, []
+    started = time.perf_counter()
+    records = itertools.islice(read_records(source), skip, None)
+
+    with app.app_context(), ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            batch = list(itertools.islice(records, args.batch_size))
+            if not batch:
+                break
+            batch_imported, downloads = import_batch(pool, batch, args.type, not args.no_covers, failures)
+            imported += batch_imported
+            processed += len(batch)
+            # saved as soon as the rows are committed, a resumed import must never insert them again
+            save_checkpoint(checkpoint, source, processed)
+            covers += import_covers(pool, downloads, failures)
+            elapsed = time.perf_counter() - started
+            print(f'{processed} rows done, {imported} imported, {len(failures)} failures, {imported / elapsed:.1f} items/s')
+
+    elapsed = time.perf_counter() - started
+    print(f'Imported {imported} items and {covers} covers from {processed - skip} rows in {elapsed:.1f}s '
+          f'({imported / elapsed if elapsed else 0:.1f} items/s)')
+    if failures:
+        reasons = Counter(type(error).__name__ for _, error in failures)
+        print(f'{len(failures)} failures: ' + ', '.join(f'{name} x{count}' for name, count in reasons.most_common()))
+        for record, error in failures[:10]:
+            print(f'  {json.dumps(record)}: {error}')
+        if args.failures:
+            with open(args.failures, 'w') as failures_file:
+                for record, error in failures:
+                    failures_file.write(json.dumps({'record': record, 'error': str(error)}) + '\n')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,4 +1,8 @@
 from app import app, db
+from migrations import upgrade
 
 with app.app_context():
     db.create_all()
+    # bring a database created by an older version up to date, a fresh one just gets its version recorded
+    for version, name in upgrade(db.engine):
+        print(f'Applied migration {version}: {name}')
@@ -0,0 +1,171 @@
+import json
+import logging
+import threading
+import time
+from bisect import bisect_left
+
+from flask import g, has_request_context, request
+from flask.signals import before_render_template, request_finished, request_started, signals_available, template_rendered
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+logger = logging.getLogger(__name__)
+
+# Where the time of a request goes: number of queries and time spent in the database, rendering templates
+# and waiting on Open Library / OMDb, measured with SQLAlchemy engine events, Flask signals and a requests
+# response hook. Each response gets a Server-Timing header (shown in the browser's network panel), requests
+# and queries slower than a threshold are logged as one JSON line each, and every endpoint keeps a latency
+# histogram in memory. Nothing is hooked up unless init_app is called, so when it is off it costs nothing.
+
+BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000)  # upper bounds, plus one bucket for slower
+
+
+class RequestTimings:
+    __slots__ = ('started', 'queries', 'db', 'template', 'http', 'template_depth', 'template_started')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db = self.template = self.http = 0.0
+        self.template_depth = 0
+        self.template_started = 0.0
+
+
+class EndpointStats:
+    def __init__(self):
+        self.count = 0
+        self.histogram = [0] * (len(BUCKETS_MS) + 1)
+        self.total_ms = self.max_ms = 0.0
+        self.queries = 0
+        self.db_ms = self.template_ms = self.http_ms = 0.0
+
+    def add(self, timings, total_ms):
+        self.count += 1
+        self.histogram[bisect_left(BUCKETS_MS, total_ms)] += 1
+        self.total_ms += total_ms
+        self.max_ms = max(self.max_ms, total_ms)
+        self.queries += timings.queries
+        self.db_ms += timings.db * 1000
+        self.template_ms += timings.template * 1000
+        self.http_ms += timings.http * 1000
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'mean_ms': round(self.total_ms / self.count, 3),
+            'max_ms': round(self.max_ms, 3),
+            'mean_queries': round(self.queries / self.count, 2),
+            'mean_db_ms': round(self.db_ms / self.count, 3),
+            'mean_template_ms': round(self.template_ms / self.count, 3),
+            'mean_http_ms': round(self.http_ms / self.count, 3),
+            'histogram': [[bound, count] for bound, count in zip(BUCKETS_MS + ('inf',), self.histogram)],
+        }
+
+
+class Instrumentation:
+    def __init__(self, slow_request_ms=500, slow_query_ms=100):
+        self.slow_request_ms = slow_request_ms
+        self.slow_query_ms = slow_query_ms
+        self.enabled = False
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        if not signals_available:
+            raise RuntimeError('request instrumentation needs the blinker package for Flask signals')
+        # every engine, so it keeps working when the database URI is changed after startup
+        event.listen(Engine, 'before_cursor_execute', self._before_query)
+        event.listen(Engine, 'after_cursor_execute', self._after_query)
+        request_started.connect(self._request_started, app)
+        request_finished.connect(self._request_finished, app)
+        before_render_template.connect(self._before_render, app)
+        template_rendered.connect(self._rendered, app)
+        self.enabled = True
+
+    def track_session(self, session):
+        # count the time outbound calls made through a requests.Session take during a request
+        session.hooks['response'].append(self._response)
+
+    def snapshot(self):
+        with self._lock:
+            endpoints = {endpoint: stats.as_dict() for endpoint, stats in sorted(self._stats.items())}
+        return {'buckets_ms': list(BUCKETS_MS), 'endpoints': endpoints}
+
+    def reset(self):
+        with self._lock:
+            self._stats.clear()
+
+    def _current(self):
+        return g.get('request_timings') if has_request_context() else None
+
+    def _request_started(self, sender, **extra):
+        g.request_timings = RequestTimings()
+
+    def _request_finished(self, sender, response, **extra):
+        timings = self._current()
+        if timings is None:
+            return
+        total_ms = (time.perf_counter() - timings.started) * 1000
+        response.headers['Server-Timing'] = ', '.join((
+            f'db;dur={timings.db * 1000:.1f};desc="{timings.queries} queries"',
+            f'tpl;dur={timings.template * 1000:.1f}',
+            f'http;dur={timings.http * 1000:.1f}',
+            f'total;dur={total_ms:.1f}',
+        ))
+
+        endpoint = request.endpoint or 'unmatched'
+        with self._lock:
+            stats = self._stats.get(endpoint)
+            if stats is None:
+                stats = self._stats[endpoint] = EndpointStats()
+            stats.add(timings, total_ms)
+
+        if total_ms >= self.slow_request_ms:
+            logger.warning(json.dumps({
+                'event': 'slow_request', 'method': request.method, 'path': request.full_path.rstrip('?'),
+                'endpoint': endpoint, 'status': response.status_code, 'total_ms': round(total_ms, 1),
+                'queries': timings.queries, 'db_ms': round(timings.db * 1000, 1),
+                'template_ms': round(timings.template * 1000, 1), 'http_ms': round(timings.http * 1000, 1),
+            }))
+
+    def _before_query(self, conn, cursor, statement, parameters, context, executemany):
+        # Kept on the statement's execution context rather than a stack on the connection, so a query that
+        # raises (after_cursor_execute never runs) leaves nothing behind for the next query to be timed
+        # against. The few internal statements run without a context are not timed.
+        if context is not None:
+            context.query_started = time.perf_counter()
+
+    def _after_query(self, conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, 'query_started', None)
+        if started is None:
+            return
+        elapsed = time.perf_counter() - started
+        timings = self._current()
+        if timings is not None:
+            timings.queries += 1
+            timings.db += elapsed
+        if elapsed * 1000 >= self.slow_query_ms:
+            logger.warning(json.dumps({
+                'event': 'slow_query', 'duration_ms': round(elapsed * 1000, 1), 'statement': statement[:500],
+                'path': request.path if has_request_context() else None,
+            }))
+
+    def _before_render(self, sender, template, context, **extra):
+        # only the outermost render is timed, in case a template is rendered while rendering another
+        timings = self._current()
+        if timings is not None:
+            if timings.template_depth == 0:
+                timings.template_started = time.perf_counter()
+            timings.template_depth += 1
+
+    def _rendered(self, sender, template, context, **extra):
+        timings = self._current()
+        if timings is not None and timings.template_depth:
+            timings.template_depth -= 1
+            if timings.template_depth == 0:
+                timings.template += time.perf_counter() - timings.template_started
+
+    def _response(self, response, *args, **kwargs):
+        timings = self._current()
+        if timings is not None:
+            timings.http += response.elapsed.total_seconds()
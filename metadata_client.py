@@ -0,0 +1,195 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Lookups of book details on Open Library (by ISBN) and movie details on OMDb (by IMDB id).
+# Responses are kept in a small SQLite file so re-submitting the same id costs no HTTP call,
+# lookups that found nothing are remembered for a shorter time, and every request goes through
+# one pooled requests.Session with connect/read timeouts so a stalled upstream can't hang a worker.
+
+OPEN_LIBRARY_URL = 'https://openlibrary.org/api/books'
+OMDB_URL = 'http://www.omdbapi.com/'
+# OMDb answers every error with HTTP 200 and {"Response": "False", "Error": ...}; only these mean the id
+# has no movie; the rest (request limit reached, invalid or missing API key, ...) are not cached
+OMDB_NOT_FOUND_ERRORS = {'Movie not found!', 'Incorrect IMDb ID.'}
+
+
+class MetadataError(Exception):
+    # the upstream could not be reached or answered with an error, nothing is cached
+    pass
+
+
+class MetadataNotFound(MetadataError):
+    # the upstream answered but has no such ISBN / IMDB id, this is cached for negative_ttl
+    pass
+
+
+class HttpBackend:
+    def __init__(self, connect_timeout=3.05, read_timeout=10, pool_size=10):
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get_json(self, url, params):
+        try:
+            response = self.session.get(url, params=params, timeout=self.timeout)
+            response.raise_for_status()
+            return response.json()
+        except (requests.RequestException, ValueError) as error:
+            raise MetadataError(str(error)) from error
+
+
+class FakeBackend:
+    # Offline stand-in: `responses` maps (url, identifier) to the JSON the real API would return.
+    # Anything not listed answers like the API does for an unknown id; every call is kept in `calls`.
+
+    def __init__(self, responses=None, fail=False):
+        self.responses = responses or {}
+        self.fail = fail
+        self.calls = []
+
+    def get_json(self, url, params):
+        identifier = params.get('bibkeys') or params.get('i')
+        self.calls.append((url, identifier))
+        if self.fail:
+            raise MetadataError('fake backend is failing')
+        if (url, identifier) in self.responses:
+            return self.responses[(url, identifier)]
+        return {} if url == OPEN_LIBRARY_URL else {'Response': 'False', 'Error': 'Incorrect IMDb ID.'}
+
+
+MISSING = object()
+
+
+class ResponseCache:
+    # JSON responses on disk with a per-entry expiry, trimmed least recently used first past max_bytes
+
+    def __init__(self, path, max_bytes=50 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute('CREATE TABLE IF NOT EXISTS response_cache ('
+                         'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+                         'expires_at REAL NOT NULL, used_at REAL NOT NULL)')
+            conn.execute('CREATE INDEX IF NOT EXISTS ix_response_cache_used_at ON response_cache (used_at)')
+
+    @contextmanager
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def get(self, key):
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute('SELECT value, expires_at FROM response_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return MISSING
+            if row[1] < now:
+                conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+                return MISSING
+            conn.execute('UPDATE response_cache SET used_at = ? WHERE key = ?', (now, key))
+        return json.loads(row[0])
+
+    def set(self, key, value, ttl):
+        encoded = json.dumps(value)
+        now = time.time()
+        with self._lock, self._connect() as conn:
+            conn.execute('INSERT OR REPLACE INTO response_cache (key, value, size, expires_at, used_at) '
+                         'VALUES (?, ?, ?, ?, ?)', (key, encoded, len(encoded), now + ttl, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn, now):
+        conn.execute('DELETE FROM response_cache WHERE expires_at < ?', (now,))
+        total = conn.execute('SELECT COALESCE(SUM(size), 0) FROM response_cache').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # drop the least recently used entries until we are back under 90% of the limit
+        excess = total - self.max_bytes * 0.9
+        for key, size in conn.execute('SELECT key, size FROM response_cache ORDER BY used_at').fetchall():
+            if excess <= 0:
+                break
+            conn.execute('DELETE FROM response_cache WHERE key = ?', (key,))
+            excess -= size
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute('DELETE FROM response_cache')
+
+
+def _omdb_outcome(payload):
+    if payload.get('Response') == 'True':
+        return 'found'
+    return 'not_found' if payload.get('Error') in OMDB_NOT_FOUND_ERRORS else 'error'
+
+
+class MetadataClient:
+    def __init__(self, backend, cache=None, ttl=7 * 24 * 3600, negative_ttl=3600, omdb_api_key=None):
+        self.backend = backend
+        self.cache = cache
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.omdb_api_key = omdb_api_key
+
+    def _cached_json(self, key, url, params, outcome):
+        # outcome(payload) is 'found', 'not_found' or anything else for an error answer that isn't cached
+        if self.cache is not None:
+            cached = self.cache.get(key)
+            if cached is not MISSING:
+                return cached
+        payload = self.backend.get_json(url, params)
+        ttl = {'found': self.ttl, 'not_found': self.negative_ttl}.get(outcome(payload))
+        if self.cache is not None and ttl is not None:
+            self.cache.set(key, payload, ttl)
+        return payload
+
+    def lookup_isbn(self, isbn):
+        # {title, author, genre, synopsis, cover_url} for a book
+        isbn = isbn.replace('-', '').replace(' ', '').upper()
+        bibkey = f'ISBN:{isbn}'
+        params = {'bibkeys': bibkey, 'jscmd': 'data', 'format': 'json'}
+        payload = self._cached_json(f'openlibrary:{isbn}', OPEN_LIBRARY_URL, params,
+                                    lambda data: 'found' if data.get(bibkey) else 'not_found')
+        book_data = payload.get(bibkey)
+        if not book_data:
+            raise MetadataNotFound(f'No book details found for ISBN: {isbn}')
+        return {
+            'title': book_data.get('title', ''),
+            'author': ', '.join(author.get('name', '') for author in book_data.get('authors', [])),
+            'genre': ', '.join(subject.get('name', '') for subject in book_data.get('subjects', [])[:3]),
+            'synopsis': ', '.join(excerpt.get('text', '') for excerpt in book_data.get('excerpts', [])),
+            'cover_url': book_data.get('cover', {}).get('medium'),
+        }
+
+    def lookup_imdb(self, imdb):
+        # {title, director, genre, synopsis, cover_url} for a movie, MetadataNotFound carries OMDb's message
+        imdb = imdb.strip().lower()
+        params = {'i': imdb, 'apikey': self.omdb_api_key}
+        payload = self._cached_json(f'omdb:{imdb}', OMDB_URL, params, _omdb_outcome)
+        if payload.get('Response') != 'True':
+            if _omdb_outcome(payload) != 'not_found':
+                raise MetadataError(payload.get('Error', 'OMDb returned an error'))
+            raise MetadataNotFound(payload.get('Error', 'Movie not found.'))
+        poster = payload.get('Poster', '')
+        return {
+            'title': payload.get('Title', ''),
+            'director': payload.get('Director', ''),
+            'genre': payload.get('Genre', ''),
+            'synopsis': payload.get('Plot', ''),
+            'cover_url': poster if poster.startswith('http') else None,
+        }
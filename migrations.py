@@ -0,0 +1,120 @@
+from datetime import datetime
+
+from sqlalchemy import DateTime, bindparam, inspect, text
+
+from counters import reconcile_review_counters
+from genres import backfill_genres
+from search import INDEXED_TYPES, create_search_index, rebuild_search_index
+
+# Versioned schema changes for databases created before the matching model change.
+# Each migration runs once, in version order, and is recorded in the schema_version table.
+# db.create_all() builds new databases straight from the current models, so migrations have to
+# check for what they add and be safe to run against a schema that already has it.
+
+MIGRATIONS = []
+
+
+def migration(version):
+    def register(func):
+        MIGRATIONS.append((version, func))
+        MIGRATIONS.sort(key=lambda entry: entry[0])
+        return func
+    return register
+
+
+def has_column(conn, table, column):
+    return column in {col['name'] for col in inspect(conn).get_columns(table)}
+
+
+def add_column(conn, table, column, ddl):
+    if not has_column(conn, table, column):
+        conn.execute(text(f'ALTER TABLE {table} ADD COLUMN {column} {ddl}'))
+        return True
+    return False
+
+
+def datetime_ddl(conn):
+    # DATETIME on SQLite, TIMESTAMP on PostgreSQL
+    return conn.dialect.type_compiler.process(DateTime())
+
+
+def create_index(conn, name, table, columns):
+    conn.execute(text(f'CREATE INDEX IF NOT EXISTS {name} ON {table} ({", ".join(columns)})'))
+
+
+@migration(1)
+def review_timestamps_and_indexes(conn):
+    # created_at on the review tables plus (item, created_at) and (user, created_at) indexes.
+    # Existing reviews get the migration time; pages order by (created_at, id) so their old order is kept.
+    now = datetime.utcnow()
+    for table, item_fk in (('book_review', 'book_id'), ('movie_review', 'movie_id'), ('game_review', 'game_id')):
+        if add_column(conn, table, 'created_at', datetime_ddl(conn)):
+            conn.execute(text(f'UPDATE {table} SET created_at = :now WHERE created_at IS NULL')
+                         .bindparams(bindparam('now', type_=DateTime())), {'now': now})
+        create_index(conn, f'ix_{table}_{item_fk}_created_at', table, [item_fk, 'created_at'])
+        create_index(conn, f'ix_{table}_user_id_created_at', table, ['user_id', 'created_at'])
+
+
+@migration(2)
+def catalogue_search_index(conn):
+    # FTS5 table and the triggers that maintain it, filled from the items already in the database
+    if conn.dialect.name == 'sqlite':
+        create_search_index(conn)
+        rebuild_search_index(conn)
+
+
+@migration(3)
+def item_versions(conn):
+    # counter bumped by every write to an item or its reviews, used as the fragment cache key
+    for table in ('book', 'movie', 'game'):
+        add_column(conn, table, 'version', 'INTEGER NOT NULL DEFAULT 1')
+
+
+@migration(4)
+def review_counters(conn):
+    # review_count / last_reviewed_at for the "most reviewed" and "recently active" listings, filled from the reviews
+    for table in ('book', 'movie', 'game'):
+        add_column(conn, table, 'review_count', 'INTEGER NOT NULL DEFAULT 0')
+        add_column(conn, table, 'last_reviewed_at', datetime_ddl(conn))
+        create_index(conn, f'ix_{table}_most_reviewed', table, ['review_count', 'id'])
+        create_index(conn, f'ix_{table}_recently_reviewed', table, ['last_reviewed_at', 'id'])
+    reconcile_review_counters(conn)
+    if conn.dialect.name == 'sqlite':
+        # the search triggers used to re-index an item on any update, counters included
+        for _, table, _ in INDEXED_TYPES.values():
+            conn.execute(text(f'DROP TRIGGER IF EXISTS {table}_fts_update'))
+        create_search_index(conn)
+
+
+@migration(5)
+def genre_tags(conn):
+    # genre / genre_count / <type>_genre are new tables made by db.create_all(), filled here from the genre strings
+    backfill_genres(conn)
+
+
+@migration(6)
+def review_created_at_indexes(conn):
+    # the sitewide activity feed reads the newest reviews of every item and user
+    for table in ('book_review', 'movie_review', 'game_review'):
+        create_index(conn, f'ix_{table}_created_at', table, ['created_at', 'id'])
+
+
+def current_version(conn):
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version ('
+                      f'version INTEGER PRIMARY KEY, name VARCHAR(100) NOT NULL, applied_at {datetime_ddl(conn)} NOT NULL)'))
+    return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+
+def upgrade(engine):
+    # Applies every pending migration, each in its own transaction, and returns [(version, name), ...]
+    applied = []
+    for version, func in MIGRATIONS:
+        with engine.begin() as conn:
+            if version <= current_version(conn):
+                continue
+            func(conn)
+            conn.execute(text('INSERT INTO schema_version (version, name, applied_at) VALUES (:version, :name, :now)')
+                         .bindparams(bindparam('now', type_=DateTime())),
+                         {'version': version, 'name': func.__name__, 'now': datetime.utcnow()})
+        applied.append((version, func.__name__))
+    return applied
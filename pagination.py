@@ -0,0 +1,158 @@
+import random
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+
+# One page of a keyset (cursor) paginated listing
+Page = namedtuple('Page', ['items', 'next_cursor', 'prev_cursor'])
+
+DEFAULT_PAGE_SIZE = 24
+MAX_PAGE_SIZE = 100
+
+
+def encode_cursor(phase, key):
+    return f'{phase}.{key}'
+
+
+def decode_cursor(cursor):
+    # cursors look like "<phase>.<id>", anything else is treated as no cursor
+    try:
+        phase, key = cursor.split('.', 1)
+        phase, key = int(phase), int(key)
+    except (AttributeError, ValueError):
+        return None
+    if phase not in (0, 1):
+        return None
+    return phase, key
+
+
+def page_size(value, default=DEFAULT_PAGE_SIZE):
+    try:
+        size = int(value)
+    except (TypeError, ValueError):
+        return default
+    return max(1, min(size, MAX_PAGE_SIZE))
+
+
+def _phase_filter(query, column, phase, pivot):
+    # with a pivot the key space is rotated: phase 0 is [pivot, max], phase 1 is [min, pivot)
+    if pivot is None:
+        return query
+    return query.filter(column >= pivot) if phase == 0 else query.filter(column < pivot)
+
+
+def keyset_page(query, column, limit, after=None, before=None, pivot=None, descending=False, key_attribute=None):
+    # Every page is an indexed range read on `column` (the primary key), never an OFFSET or a full sort.
+    # Passing a pivot starts the walk somewhere in the middle of the table and wraps around at the end.
+    # descending walks from the highest key down (newest first) and cannot be combined with a pivot.
+    # key_attribute names the item attribute holding the key when `column` is an equal column of a
+    # joined table, e.g. the item id of a link table whose index gives the order.
+    phases = [0] if pivot is None else [0, 1]
+    forward, backward = (column.desc(), column.asc()) if descending else (column.asc(), column.desc())
+
+    def beyond(key):
+        return column < key if descending else column > key
+
+    def behind(key):
+        return column > key if descending else column < key
+
+    key_attribute = key_attribute or column.key
+    after, before = decode_cursor(after), decode_cursor(before)
+    rows = []
+
+    if before is None:
+        start_phase, start_key = after if after else (0, None)
+        for phase in phases[start_phase:]:
+            q = _phase_filter(query, column, phase, pivot)
+            if start_key is not None and phase == start_phase:
+                q = q.filter(beyond(start_key))
+            rows += [(phase, item) for item in q.order_by(forward).limit(limit + 1 - len(rows)).all()]
+            if len(rows) > limit:
+                break
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1][0], getattr(rows[-1][1], key_attribute)) if has_more else None
+        prev_cursor = encode_cursor(rows[0][0], getattr(rows[0][1], key_attribute)) if after and rows else None
+    else:
+        start_phase, start_key = before
+        for phase in reversed(phases[:start_phase + 1]):
+            q = _phase_filter(query, column, phase, pivot)
+            if phase == start_phase:
+                q = q.filter(behind(start_key))
+            rows += [(phase, item) for item in q.order_by(backward).limit(limit + 1 - len(rows)).all()]
+            if len(rows) > limit:
+                break
+        has_more = len(rows) > limit
+        rows = rows[:limit][::-1]
+        prev_cursor = encode_cursor(rows[0][0], getattr(rows[0][1], key_attribute)) if has_more else None
+        next_cursor = encode_cursor(rows[-1][0], getattr(rows[-1][1], key_attribute)) if rows else None
+
+    return Page([item for _, item in rows], next_cursor, prev_cursor)
+
+
+EPOCH = datetime(1970, 1, 1)
+
+
+def encode_key(values):
+    # compound keys go in the URL as dot separated integers, datetimes as microseconds since the epoch
+    return '.'.join(str((value - EPOCH) // timedelta(microseconds=1) if isinstance(value, datetime) else value)
+                    for value in values)
+
+
+def decode_key(cursor, types):
+    # `types` holds the python type of each part, anything malformed is treated as no cursor
+    try:
+        parts = cursor.split('.')
+        if len(parts) != len(types):
+            return None
+        return tuple(EPOCH + timedelta(microseconds=int(part)) if kind is datetime else kind(part)
+                     for part, kind in zip(parts, types))
+    except (AttributeError, ValueError, OverflowError):
+        return None
+
+
+def compound_keyset_page(query, columns, limit, after=None, before=None, descending=False):
+    # Like keyset_page but ordered by several columns, e.g. (created_at, id), so that a composite
+    # index ending in those columns serves both the filter and the ordering.
+    key = tuple_(*columns)
+    types = [column.type.python_type for column in columns]
+    forward = [column.desc() if descending else column.asc() for column in columns]
+    backward = [column.asc() if descending else column.desc() for column in columns]
+    after, before = decode_key(after, types), decode_key(before, types)
+
+    def key_of(item):
+        return encode_key(getattr(item, column.key) for column in columns)
+
+    if before is None:
+        q = query
+        if after:
+            q = q.filter(key < tuple_(*after) if descending else key > tuple_(*after))
+        items = q.order_by(*forward).limit(limit + 1).all()
+        has_more = len(items) > limit
+        items = items[:limit]
+        next_cursor = key_of(items[-1]) if has_more else None
+        prev_cursor = key_of(items[0]) if after and items else None
+    else:
+        q = query.filter(key > tuple_(*before) if descending else key < tuple_(*before))
+        items = q.order_by(*backward).limit(limit + 1).all()
+        has_more = len(items) > limit
+        items = items[:limit][::-1]
+        prev_cursor = key_of(items[0]) if has_more else None
+        next_cursor = key_of(items[-1]) if items else None
+
+    return Page(items, next_cursor, prev_cursor)
+
+
+def shuffle_pivot(seed, max_key):
+    # the same seed always starts the listing at the same place
+    if not max_key:
+        return None
+    return seed % max_key + 1
+
+
+def stable_shuffle(items, seed):
+    # shuffle a single page deterministically so going back and forth shows the same cards
+    if items:
+        random.Random(f'{seed}:{items[0].id}').shuffle(items)
+    return items
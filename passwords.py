@@ -0,0 +1,108 @@
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+
+from werkzeug.security import check_password_hash, generate_password_hash
+
+# Password hashing is deliberately slow CPU work. Done inline, a burst of logins takes every worker (and
+# core) it lands on while page views wait behind it. PasswordHasher runs it in a small process pool
+# instead: at most `workers` cores ever hash at once, and no more than `max_pending` hashes are waiting
+# or running per web worker. A login arriving beyond that waits up to `wait` seconds for a slot and then
+# gets HasherBusy, so the site answers "try again" quickly rather than queueing without bound.
+#
+# `method` is the werkzeug method including its iteration count, e.g. pbkdf2:sha256:260000. Stored
+# hashes made with other parameters still verify, and needs_rehash tells login to replace them.
+#
+# LoginLimiter counts failed logins per username and per client address in a sliding window and refuses
+# further attempts before any hashing is done. Like the identity cache it is per process.
+
+
+class HasherBusy(Exception):
+    # every hashing slot is taken
+    pass
+
+
+class PasswordHasher:
+    def __init__(self, method='pbkdf2:sha256:260000', salt_length=16, workers=2, max_pending=8, wait=2.0, timeout=30.0):
+        self.method = method
+        self.salt_length = salt_length
+        self.workers = workers
+        self.wait = wait
+        self.timeout = timeout
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pool = None
+        self._pool_lock = threading.Lock()
+
+    def _executor(self):
+        # started on first use, inside the web worker process rather than before it forks
+        with self._pool_lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self.workers)
+            return self._pool
+
+    def _run(self, func, *args):
+        if not self.workers:
+            return func(*args)
+        if not self._slots.acquire(timeout=self.wait):
+            raise HasherBusy()
+        try:
+            return self._executor().submit(func, *args).result(timeout=self.timeout)
+        except FutureTimeout:
+            raise HasherBusy() from None
+        finally:
+            self._slots.release()
+
+    def hash(self, password):
+        return self._run(generate_password_hash, password, self.method, self.salt_length)
+
+    def verify(self, stored, password):
+        return self._run(check_password_hash, stored, password)
+
+    def needs_rehash(self, stored):
+        # stored hashes look like "<method>$<salt>$<hash>"
+        method, _, rest = (stored or '').partition('$')
+        salt = rest.partition('$')[0]
+        return method != self.method or len(salt) != self.salt_length
+
+
+class LoginLimiter:
+    def __init__(self, max_per_username=5, max_per_address=20, window=300, max_keys=100000):
+        self.limits = {'user': max_per_username, 'address': max_per_address}
+        self.window = window
+        self.max_keys = max_keys
+        self._failures = OrderedDict()  # (kind, value) -> deque of failure times
+        self._lock = threading.Lock()
+
+    def _keys(self, username, address):
+        return [(('user', (username or '').lower()), self.limits['user']), (('address', address), self.limits['address'])]
+
+    def retry_after(self, username, address):
+        # seconds until another attempt is allowed, 0 when it is allowed now
+        now = time.monotonic()
+        wait = 0
+        with self._lock:
+            for key, limit in self._keys(username, address):
+                failures = self._failures.get(key)
+                if not failures:
+                    continue
+                while failures and failures[0] <= now - self.window:
+                    failures.popleft()
+                if len(failures) >= limit:
+                    wait = max(wait, failures[0] + self.window - now)
+        return wait
+
+    def failed(self, username, address):
+        now = time.monotonic()
+        with self._lock:
+            for key, limit in self._keys(username, address):
+                failures = self._failures.setdefault(key, deque(maxlen=limit))
+                failures.append(now)
+                self._failures.move_to_end(key)
+            while len(self._failures) > self.max_keys:
+                self._failures.popitem(last=False)
+
+    def succeeded(self, username):
+        with self._lock:
+            self._failures.pop(('user', (username or '').lower()), None)
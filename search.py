@@ -0,0 +1,96 @@
+import re
+
+from sqlalchemy import text
+
+# Full-text search over books, movies and games using a single SQLite FTS5 table.
+# The table is contentless (it stores only the index, not a copy of the text) and every row id
+# packs the item type into its low bits: rowid = item_id * 4 + type code. Triggers on the three
+# catalogue tables keep it up to date on every insert, update and delete, whichever code path
+# made the change, so adding or deleting through the usual routes needs no extra calls.
+# Other databases (PostgreSQL) have no FTS5 and fall back to scanning the three tables with LIKE.
+
+SEARCH_TABLE = 'catalogue_fts'
+MAX_TERMS = 8
+
+# item type -> (type code, table, creator column)
+INDEXED_TYPES = {
+    'book': (1, 'book', 'author'),
+    'movie': (2, 'movie', 'director'),
+    'game': (3, 'game', 'studio'),
+}
+TYPE_NAMES = {code: item_type for item_type, (code, _, _) in INDEXED_TYPES.items()}
+
+
+def _row_values(prefix, code, creator):
+    return (f"{prefix}.id * 4 + {code}, {prefix}.title, {prefix}.{creator}, "
+            f"{prefix}.genre, coalesce({prefix}.synopsis, '')")
+
+
+def create_search_index(conn):
+    conn.execute(text(
+        f'CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5('
+        "title, creator, genre, synopsis, content='', prefix='2 3', tokenize='unicode61 remove_diacritics 2')"
+    ))
+    columns = 'rowid, title, creator, genre, synopsis'
+    for code, table, creator in INDEXED_TYPES.values():
+        insert = f'INSERT INTO {SEARCH_TABLE} ({columns}) VALUES ({_row_values("new", code, creator)});'
+        # contentless tables are deleted from by replaying the original values
+        delete = (f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}, {columns}) "
+                  f"VALUES ('delete', {_row_values('old', code, creator)});")
+        conn.execute(text(f'CREATE TRIGGER IF NOT EXISTS {table}_fts_insert AFTER INSERT ON {table} BEGIN {insert} END'))
+        conn.execute(text(f'CREATE TRIGGER IF NOT EXISTS {table}_fts_delete AFTER DELETE ON {table} BEGIN {delete} END'))
+        # only edits of indexed text re-index, not counter or version bumps
+        conn.execute(text(f'CREATE TRIGGER IF NOT EXISTS {table}_fts_update '
+                          f'AFTER UPDATE OF title, {creator}, genre, synopsis ON {table} BEGIN {delete} {insert} END'))
+
+
+def rebuild_search_index(conn):
+    # Re-index every item from scratch, for databases that had rows before the triggers existed
+    conn.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('delete-all')"))
+    for code, table, creator in INDEXED_TYPES.values():
+        conn.execute(text(f'INSERT INTO {SEARCH_TABLE} (rowid, title, creator, genre, synopsis) '
+                          f'SELECT {_row_values(table, code, creator)} FROM {table}'))
+    conn.execute(text(f"INSERT INTO {SEARCH_TABLE} ({SEARCH_TABLE}) VALUES ('optimize')"))
+
+
+def match_expression(raw):
+    # Quote every word and match it as a prefix, so user input can never be parsed as FTS5 syntax
+    terms = re.findall(r'\w+', raw.lower())[:MAX_TERMS]
+    return ' '.join(f'"{term}"*' for term in terms)
+
+
+def search_catalogue(session, raw, limit, offset=0):
+    # Returns [(item_type, item_id), ...] best match first; titles weigh most, then creators
+    expression = match_expression(raw)
+    if not expression:
+        return []
+    if session.connection().dialect.name != 'sqlite':
+        return _search_without_index(session, re.findall(r'\w+', raw.lower())[:MAX_TERMS], limit, offset)
+    rows = session.execute(text(
+        f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :expression '
+        f'ORDER BY bm25({SEARCH_TABLE}, 10.0, 5.0, 2.0, 1.0) LIMIT :limit OFFSET :offset'
+    ), {'expression': expression, 'limit': limit, 'offset': offset})
+    return [(TYPE_NAMES[rowid & 3], rowid >> 2) for (rowid,) in rows]
+
+
+def _search_without_index(session, terms, limit, offset):
+    # Every word has to appear somewhere in the item, scored with the same field weights as bm25 above
+    params = {'limit': limit, 'offset': offset}
+    for number, term in enumerate(terms):
+        params[f'term{number}'] = '%' + term.replace('_', '\\_') + '%'  # words are \w+, so _ is the only wildcard
+
+    branches = []
+    for code, table, creator in INDEXED_TYPES.values():
+        fields = (f'lower({table}.title)', f'lower({table}.{creator})', f'lower({table}.genre)',
+                  f"lower(coalesce({table}.synopsis, ''))")
+        matches, scores = [], []
+        for number in range(len(terms)):
+            like = [f"{field} LIKE :term{number} ESCAPE '\\'" for field in fields]
+            matches.append('(' + ' OR '.join(like) + ')')
+            scores.append(f'CASE WHEN {like[0]} THEN 10 WHEN {like[1]} THEN 5 WHEN {like[2]} THEN 2 ELSE 1 END')
+        branches.append(f'SELECT {code} AS code, {table}.id AS id, {" + ".join(scores)} AS score '
+                        f'FROM {table} WHERE {" AND ".join(matches)}')
+    rows = session.execute(text(
+        ' UNION ALL '.join(branches) + ' ORDER BY score DESC, code, id LIMIT :limit OFFSET :offset'
+    ), params)
+    return [(TYPE_NAMES[code], item_id) for code, item_id, _ in rows]
@@ -0,0 +1,226 @@
+import math
+import re
+from collections import Counter
+from datetime import datetime
+
+import numpy as np
+from scipy import sparse
+from sqlalchemy import DateTime, Integer, bindparam, text
+
+from counters import COUNTED_TABLES
+from search import INDEXED_TYPES
+
+# "More like this" neighbours for the detail pages, computed offline by `flask build-similar` and stored
+# as up to k rows per item in similar_item, so showing them is a single primary key range read.
+#
+# Every item becomes one sparse vector: TF-IDF weights of its synopsis words plus its genres and creator
+# as extra terms, next to a co-review part (which users reviewed it, heavy reviewers counting less).
+# Both halves are L2 normalised and weighted, so the dot product of two vectors is
+# text_weight * text similarity + (1 - text_weight) * co-review similarity.
+#
+# A full build compares every item with every other, a block of rows at a time so memory stays bounded.
+# Otherwise only the items added or reviewed since the last build are recomputed, and then merged into
+# the lists of the other items they now belong in, which similarity being symmetric makes possible.
+
+TOKEN = re.compile(r'[a-z0-9]+')
+STOPWORDS = frozenset(
+    'the and for with that this from into their them they his her its are was were has have had but not you your '
+    'who what when where which while will would can could one two all any out our more most some than then there '
+    'these those about after before over under only also been being just very such each other'.split())
+GENRE_WEIGHT = 2.0
+CREATOR_WEIGHT = 1.5
+MAX_DF_SHARE = 0.5  # terms in more than half of the items say nothing about any of them
+BLOCK_CELLS = 16 * 1024 * 1024  # dense similarity cells computed at once, 64 MB of float32
+ID_BATCH = 500
+
+
+def _terms(synopsis, genre, creator):
+    counts = Counter(term for term in TOKEN.findall((synopsis or '').lower())
+                     if len(term) > 2 and term not in STOPWORDS)
+    weights = {term: 1 + math.log(count) for term, count in counts.items()}
+    for name in (genre or '').split(','):
+        if name.strip():
+            weights['genre:' + name.strip().lower()] = GENRE_WEIGHT
+    if creator and creator.strip():
+        weights['creator:' + creator.strip().lower()] = CREATOR_WEIGHT
+    return weights
+
+
+def _normalize(matrix):
+    norms = np.sqrt(np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    return (sparse.diags(1 / norms) @ matrix).astype(np.float32)
+
+
+def text_matrix(rows):
+    # rows of (synopsis, genre, creator) in id order -> L2 normalised TF-IDF matrix, one row per item
+    vocabulary, indptr, indices, values = {}, [0], [], []
+    for synopsis, genre, creator in rows:
+        for term, weight in _terms(synopsis, genre, creator).items():
+            indices.append(vocabulary.setdefault(term, len(vocabulary)))
+            values.append(weight)
+        indptr.append(len(indices))
+    matrix = sparse.csr_matrix((np.array(values, dtype=np.float32), np.array(indices, dtype=np.int64), indptr),
+                               shape=(len(indptr) - 1, max(len(vocabulary), 1)))
+    count = matrix.shape[0]
+    df = np.bincount(matrix.indices, minlength=matrix.shape[1])
+    idf = np.log((1 + count) / (1 + df)) + 1
+    idf[df > max(2, MAX_DF_SHARE * count)] = 0
+    return _normalize(matrix @ sparse.diags(idf)).tocsr()
+
+
+def coreview_matrix(pairs, ids):
+    # (item_id, user_id) review pairs -> L2 normalised item x user matrix; users with many reviews weigh less
+    pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+    positions = np.searchsorted(ids, pairs[:, 0])
+    known = positions < len(ids)
+    known[known] = ids[positions[known]] == pairs[known, 0]
+    if not known.any():
+        return sparse.csr_matrix((len(ids), 1), dtype=np.float32)
+    users, user_index, user_counts = np.unique(pairs[known, 1], return_inverse=True, return_counts=True)
+    weights = 1 / np.log(2 + user_counts[user_index])
+    matrix = sparse.csr_matrix((weights, (positions[known], user_index)), shape=(len(ids), len(users)))
+    return _normalize(matrix).tocsr()
+
+
+def feature_matrix(conn, item_type, text_weight):
+    # (sorted item ids, one combined feature row per item)
+    _, table, creator = INDEXED_TYPES[item_type]
+    review_table, item_fk = COUNTED_TABLES[table]
+    rows = conn.execute(text(f'SELECT id, synopsis, genre, {creator} FROM {table} ORDER BY id')).fetchall()
+    ids = np.array([row[0] for row in rows], dtype=np.int64)
+    words = text_matrix(row[1:] for row in rows)
+    reviews = coreview_matrix(conn.execute(text(f'SELECT DISTINCT {item_fk}, user_id FROM {review_table}')).fetchall(), ids)
+    return ids, sparse.hstack([words * math.sqrt(text_weight), reviews * math.sqrt(1 - text_weight)]).tocsr()
+
+
+def _blocks(positions, width):
+    size = max(1, BLOCK_CELLS // max(width, 1))
+    for start in range(0, len(positions), size):
+        yield positions[start:start + size]
+
+
+def _top(scores, ids, k):
+    # best k (id, score) pairs of one row of similarities, leaving out anything not similar at all
+    if k < len(scores):
+        best = np.argpartition(-scores, k - 1)[:k]
+    else:
+        best = np.arange(len(scores))
+    best = best[np.argsort(-scores[best], kind='stable')]
+    return [(int(ids[column]), float(scores[column])) for column in best if scores[column] > 0]
+
+
+def _positions(ids, wanted):
+    # row numbers of the wanted ids that exist, in id order
+    wanted = np.array(sorted(wanted), dtype=np.int64)
+    positions = np.searchsorted(ids, wanted)
+    found = positions < len(ids)
+    found[found] = ids[positions[found]] == wanted[found]
+    return positions[found]
+
+
+def _changed_positions(conn, item_type, ids):
+    # items added or reviewed since the last build, None when there was no build yet
+    _, table, _ = INDEXED_TYPES[item_type]
+    state = conn.execute(text('SELECT built_at, max_id FROM similar_build WHERE item_type = :item_type')
+                         .columns(built_at=DateTime(), max_id=Integer()), {'item_type': item_type}).first()
+    if state is None:
+        return None
+    reviewed = conn.execute(text(f'SELECT id FROM {table} WHERE last_reviewed_at > :built_at')
+                            .bindparams(bindparam('built_at', type_=DateTime())), {'built_at': state.built_at})
+    return _positions(ids, {item_id for (item_id,) in reviewed} | set(ids[ids > state.max_id].tolist()))
+
+
+def _thresholds(conn, item_type, ids, k):
+    # the score a newcomer has to reach to enter each item's list: its k-th best, or 0 while it has fewer than k
+    threshold = np.zeros(len(ids), dtype=np.float32)
+    for item_id, count, lowest in conn.execute(text(
+            'SELECT item_id, count(*), min(score) FROM similar_item WHERE item_type = :item_type GROUP BY item_id'),
+            {'item_type': item_type}):
+        position = np.searchsorted(ids, item_id)
+        if count >= k and position < len(ids) and ids[position] == item_id:
+            threshold[position] = lowest
+    return threshold
+
+
+def _lists_pointing_at(conn, item_type, similar_ids):
+    item_ids = set()
+    for start in range(0, len(similar_ids), ID_BATCH):
+        item_ids.update(item_id for (item_id,) in conn.execute(
+            text('SELECT DISTINCT item_id FROM similar_item WHERE item_type = :item_type AND similar_id IN :ids')
+            .bindparams(bindparam('ids', expanding=True)),
+            {'item_type': item_type, 'ids': similar_ids[start:start + ID_BATCH]}))
+    return item_ids
+
+
+def _current_lists(conn, item_type, item_ids):
+    lists = {}
+    rows = conn.execute(text('SELECT item_id, similar_id, score FROM similar_item '
+                             'WHERE item_type = :item_type AND item_id IN :ids ORDER BY item_id, position')
+                        .bindparams(bindparam('ids', expanding=True)), {'item_type': item_type, 'ids': item_ids})
+    for item_id, similar_id, score in rows:
+        lists.setdefault(item_id, []).append((similar_id, score))
+    return lists
+
+
+def refresh_similar(conn, item_type, k=12, text_weight=0.7, full=False):
+    # Recomputes the neighbours of changed items (of all items with full=True), returns how many lists were written
+    started = datetime.utcnow()
+    ids, features = feature_matrix(conn, item_type, text_weight)
+    if not len(ids):
+        conn.execute(text('DELETE FROM similar_item WHERE item_type = :item_type'), {'item_type': item_type})
+        return 0
+
+    changed = None if full else _changed_positions(conn, item_type, ids)
+    incremental = changed is not None
+    if not incremental:
+        changed = np.arange(len(ids))
+    else:
+        threshold = _thresholds(conn, item_type, ids, k)
+        candidates = np.zeros(len(ids), dtype=bool)
+
+    # new lists for the changed items, noting which other items score one of them above their k-th best
+    lists = {}
+    everything = features.T.tocsc()
+    for block in _blocks(changed, len(ids)):
+        scores = (features[block] @ everything).toarray()
+        scores[np.arange(len(block)), block] = 0
+        for row, position in enumerate(block):
+            lists[int(ids[position])] = _top(scores[row], ids, k)
+        if incremental:
+            candidates |= ((scores > 0) & (scores >= threshold)).any(axis=0)
+
+    if incremental and len(changed):
+        # merge the changed items into the other lists they now enter, or already were in with an old score
+        changed_ids = ids[changed]
+        changed_set = set(changed_ids.tolist())
+        affected = (set(ids[candidates].tolist()) | _lists_pointing_at(conn, item_type, changed_ids.tolist())) - changed_set
+        columns = features[changed].T.tocsc()
+        for block in _blocks(_positions(ids, affected), len(changed)):
+            scores = (features[block] @ columns).toarray()
+            current = _current_lists(conn, item_type, ids[block].tolist())
+            for row, position in enumerate(block):
+                item_id = int(ids[position])
+                kept = [pair for pair in current.get(item_id, []) if pair[0] not in changed_set]
+                fresh = _top(scores[row], changed_ids, len(changed_ids))
+                lists[item_id] = sorted(kept + fresh, key=lambda pair: -pair[1])[:k]
+
+    _write(conn, item_type, lists)
+    conn.execute(text('DELETE FROM similar_build WHERE item_type = :item_type'), {'item_type': item_type})
+    conn.execute(text('INSERT INTO similar_build (item_type, built_at, max_id) VALUES (:item_type, :built_at, :max_id)')
+                 .bindparams(bindparam('built_at', type_=DateTime())),
+                 {'item_type': item_type, 'built_at': started, 'max_id': int(ids[-1])})
+    return len(lists)
+
+
+def _write(conn, item_type, lists):
+    item_ids = sorted(lists)
+    for start in range(0, len(item_ids), ID_BATCH):
+        conn.execute(text('DELETE FROM similar_item WHERE item_type = :item_type AND item_id IN :ids')
+                     .bindparams(bindparam('ids', expanding=True)),
+                     {'item_type': item_type, 'ids': item_ids[start:start + ID_BATCH]})
+    rows = [{'item_type': item_type, 'item_id': item_id, 'position': position, 'similar_id': similar_id, 'score': score}
+            for item_id in item_ids for position, (similar_id, score) in enumerate(lists[item_id])]
+    for start in range(0, len(rows), 5000):
+        conn.execute(text('INSERT INTO similar_item (item_type, item_id, position, similar_id, score) '
+                          'VALUES (:item_type, :item_id, :position, :similar_id, :score)'), rows[start:start + 5000])
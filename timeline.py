@@ -0,0 +1,80 @@
+from datetime import datetime
+
+from sqlalchemy import literal, select, tuple_, union_all
+
+from pagination import Page, decode_key, encode_key
+
+
+# A user's book, movie and game reviews (everyone's with user_id=None) merged into one newest-first list by the database.
+# `sources` is a list of (item_type, review_model, item_model, item_fk) tuples; the position of a
+# source in the list is its rank, which breaks ties between reviews of different types written at
+# the same instant so the interleaving is the same on every page.
+# Rows are ordered by (created_at, rank, id), each branch is served by the (user_id, created_at) index,
+# or the created_at index for the whole site.
+
+CURSOR_TYPES = (datetime, int, int)
+
+
+def encode_timeline_cursor(row):
+    return encode_key((row.created_at, row.type_rank, row.id))
+
+
+def _branch(rank, item_type, review_model, item_model, item_fk, user_id, cursor, newer, limit):
+    query = select(
+        literal(item_type).label('item_type'),
+        literal(rank).label('type_rank'),
+        review_model.id.label('id'),
+        review_model.created_at.label('created_at'),
+        review_model.content.label('content'),
+        item_fk.label('item_id'),
+        item_model.title.label('title'),
+        review_model.user_id.label('user_id'),
+    ).join_from(review_model, item_model, item_fk == item_model.id)
+    if user_id is not None:
+        query = query.where(review_model.user_id == user_id)
+
+    if cursor:
+        # the rank is constant within a branch, so the three part comparison collapses to a bound on created_at
+        # (or on (created_at, id) for the branch the cursor came from)
+        cursor_at, cursor_rank, cursor_id = cursor
+        if rank == cursor_rank:
+            key, bound = tuple_(review_model.created_at, review_model.id), tuple_(cursor_at, cursor_id)
+            query = query.where(key > bound if newer else key < bound)
+        elif newer:
+            query = query.where(review_model.created_at >= cursor_at if rank > cursor_rank else review_model.created_at > cursor_at)
+        else:
+            query = query.where(review_model.created_at <= cursor_at if rank < cursor_rank else review_model.created_at < cursor_at)
+
+    # every branch is limited on its own, so the merge only ever sees a few rows per review type
+    if newer:
+        query = query.order_by(review_model.created_at.asc(), review_model.id.asc())
+    else:
+        query = query.order_by(review_model.created_at.desc(), review_model.id.desc())
+    return select(query.limit(limit).subquery())
+
+
+def review_timeline(session, sources, user_id, limit, after=None, before=None):
+    before = decode_key(before, CURSOR_TYPES)
+    after = None if before else decode_key(after, CURSOR_TYPES)
+    newer = before is not None
+    cursor = before or after
+
+    merged = union_all(*[
+        _branch(rank, item_type, review_model, item_model, item_fk, user_id, cursor, newer, limit + 1)
+        for rank, (item_type, review_model, item_model, item_fk) in enumerate(sources)
+    ]).subquery()
+
+    columns = (merged.c.created_at, merged.c.type_rank, merged.c.id)
+    order = [column.asc() if newer else column.desc() for column in columns]
+    rows = session.execute(select(merged).order_by(*order).limit(limit + 1)).all()
+
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if newer:
+        rows.reverse()
+        prev_cursor = encode_timeline_cursor(rows[0]) if has_more else None
+        next_cursor = encode_timeline_cursor(rows[-1]) if rows else None
+    else:
+        next_cursor = encode_timeline_cursor(rows[-1]) if has_more else None
+        prev_cursor = encode_timeline_cursor(rows[0]) if after and rows else None
+    return Page(rows, next_cursor, prev_cursor)